@@ -1,23 +1,46 @@
+import os
+
+# Must run before anything else imports socket, threading or time
+if os.environ.get('SOCKETIO_ASYNC_MODE') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 import json
 import logging
-import threading
 
 import flask
-from flask_socketio import join_room, leave_room
+from flask_socketio import emit, join_room, leave_room
 import db
+import subscriptions
+from candles import freq_to_seconds
 from extension import app, socketio  # Import from extensions
+from price_paths import price_paths
+from price_store import price_store
 from routes import auth, groups, trading
+from sharding import shard_for
 
 logging.basicConfig(level=logging.INFO,
                     format="%(processName)s  %(asctime)s - %(name)s - %(levelname)s - %(message)s",
                     datefmt='%d-%b-%y %H:%M:%S')
 
-# Initialize DB at import time
+price_store.configure(app.config['PRICE_DTYPE'], app.config['PRICE_MMAP_DIR'], app.config['PRICE_MMAP_MIN_POINTS'])
+price_paths.configure(app.config['PRICE_PATH_CACHE_SIZE'])
+
+# Initialize DB at import time, replaying the journal instead when one is configured
 with open("./config/initData.json", "r") as f:
     x = json.load(f)
-    for g in x["groups"]:
-        trading.lock[g["id"]] = threading.RLock()
-    db.init(x)
+    x["groups"] = [g for g in x["groups"] if shard_for(g["id"], app.config['SHARD_COUNT']) == app.config['SHARD_INDEX']]
+    if app.config['JOURNAL_DIR']:
+        # Under gevent, fsync would block the hub, so the journal does its file I/O on a real thread
+        run_blocking = None
+        if app.config['SOCKETIO_ASYNC_MODE'] == 'gevent':
+            import gevent
+            run_blocking = gevent.get_hub().threadpool.apply
+        db.init_durable(app.config['JOURNAL_DIR'], x, app.config['JOURNAL_FLUSH_INTERVAL'], app.config['SNAPSHOT_INTERVAL'],
+                        run_blocking)
+        trading.resume_sessions()
+    else:
+        db.init(x)
 
 # Register blueprints
 app.register_blueprint(auth.bp)
@@ -30,36 +53,107 @@ def get_all_client_sessions():
     """Returns a list of all active client session IDs."""
     return list(socketio.server.manager.rooms.get('/', {}).keys())
 
+def _membership_error(group_id, user_id):
+    if db.db_instance.get_group_state(group_id) is None:
+        return 'Group not found'
+    if not db.db_instance.check_user(group_id, user_id):
+        return 'User is not a member of this group'
+    return None
+
 def on_join(data):
     group_id = data['group_id']
     user_id = data['user_id']
-    with trading.lock[group_id]:
-        trading.rooms[group_id+user_id] = {'room_id': group_id+user_id, "user_id": user_id}
+    error = _membership_error(group_id, user_id)
+    if error:
+        emit('my_response', {'error': error})
+        return
+    sub = trading.subscriptions.subscribe(group_id, user_id, subscriptions.MARKET, flask.request.sid)
     logging.info("Client asked to join group %s", group_id)
-    join_room(group_id+user_id)
-    socketio.emit('my_response', {'message': 'Successfully joined room ' + group_id})
+    join_room(sub['room_id'])
+    emit('my_response', {'message': 'Successfully joined room ' + group_id})
 
 def on_join_group_details(data):
     group_id = data['group_id']
     freq = data['freq']
     user_id = data['user_id']
-    with trading.lock[group_id]:
-        trading.details_rooms[group_id+"details"+user_id] = {'freq': freq, 'room_id': group_id+"details"+freq+user_id, "user_id": user_id}
+    # "delta" subscribers get the full series once here and only the changed bars on each tick
+    mode = data.get('mode', 'full')
+    if mode not in ('full', 'delta'):
+        emit('my_response', {'error': 'mode must be either full or delta'})
+        return
+    try:
+        freq_to_seconds(freq)
+    except ValueError as e:
+        emit('my_response', {'error': str(e)})
+        return
+    error = _membership_error(group_id, user_id)
+    if error:
+        emit('my_response', {'error': error})
+        return
+    # Snapshot and room joins happen under the group lock: a tick built earlier is in the snapshot (its delta
+    # may still arrive after the join, with a seq the client drops) and every later tick reaches these rooms
+    with db.db_instance.group_lock(group_id):
+        sub = trading.subscriptions.subscribe(group_id, user_id, subscriptions.DETAILS, flask.request.sid, freq=freq, mode=mode)
+        if mode == 'delta':
+            emit('market_snapshot_details', db.db_instance.get_price_snapshot(group_id, freq))
+        # Candles arrive on the shared (freq, mode) room, this user's pnl on its own room
+        join_room(subscriptions.details_room(group_id, freq, mode))
+        join_room(sub['room_id'])
     logging.info("Client asked to join group details %s", group_id)
-    join_room(group_id+"details"+freq+user_id)
-    socketio.emit('my_response', {'message': 'Successfully joined room ' + group_id})
+    emit('my_response', {'message': 'Successfully joined room ' + group_id})
 
 def on_join_group_leaderboard(data):
     group_id = data['group_id']
+    user_id = data.get('user_id')
     logging.info("Client asked to join group Leaderboard %s", group_id)
-    join_room(group_id+"leaderboard")
-    socketio.emit('my_response', {'message': 'Successfully joined room ' + group_id})
+    if db.db_instance.get_group_state(group_id) is None:
+        emit('my_response', {'error': 'Group not found'})
+        return
+    if user_id is None:
+        # Without a user the client gets the full ranking whenever it changes
+        join_room(group_id+"leaderboard")
+        emit('leaderboard_details', db.db_instance.get_leaderboard(group_id))
+    else:
+        error = _membership_error(group_id, user_id)
+        if error:
+            emit('my_response', {'error': error})
+            return
+        top_n = data.get('top_n', 10)
+        if isinstance(top_n, str) and top_n.isdigit():
+            top_n = int(top_n)
+        if not isinstance(top_n, int) or isinstance(top_n, bool) or top_n <= 0:
+            emit('my_response', {'error': 'top_n must be a positive integer'})
+            return
+        sub = trading.subscriptions.subscribe(group_id, user_id, subscriptions.LEADERBOARD, flask.request.sid, top_n=top_n)
+        join_room(sub['room_id'])
+        emit('leaderboard_details', trading.leaderboard_view(group_id, user_id, top_n))
+    emit('my_response', {'message': 'Successfully joined room ' + group_id})
 
 def on_leave(data):
     group_id = data['group_id']
     logging.info("Client asked to leave group %s", group_id)
-    leave_room(group_id)
-    socketio.emit('my_response', {'message': 'Successfully left room ' + group_id})
+    for sub in trading.subscriptions.unsubscribe_sid(flask.request.sid, group_id):
+        leave_room(sub['room_id'])
+        if sub.get('freq'):
+            leave_room(subscriptions.details_room(group_id, sub['freq'], sub['mode']))
+    leave_room(group_id+"leaderboard")
+    emit('my_response', {'message': 'Successfully left room ' + group_id})
+
+def on_place_order(data):
+    # The return value is the client's ack, tagged with its own client_order_id for correlation
+    payload, status = trading.submit_order(data)
+    ack = {'client_order_id': data.get('client_order_id') if isinstance(data, dict) else None}
+    if status == 200 and 'order' in payload:
+        ack.update(status='OPEN', order_id=payload['order']['order_id'])
+    elif status == 200:
+        ack.update(status='FILLED', price=payload['price'], available_coins=payload['available_coins'])
+    else:
+        ack.update(status='REJECTED', error=payload['error'])
+    return ack
+
+def on_disconnect(reason=None):
+    # Socket.IO drops the rooms itself, only the registry needs cleaning up
+    trading.subscriptions.unsubscribe_sid(flask.request.sid)
 
 
 # Attach event handlers
@@ -67,7 +161,14 @@ socketio.on_event("join_group", on_join)
 socketio.on_event("join_group_details", on_join_group_details)
 socketio.on_event("join_group_leaderboard", on_join_group_leaderboard)
 socketio.on_event("leave_group", on_leave)
+socketio.on_event("place_order", on_place_order)
+socketio.on_event("disconnect", on_disconnect)
 
 
 if __name__ == '__main__':
-    socketio.run(app, allow_unsafe_werkzeug=True)
+    host = os.environ.get('HOST', '127.0.0.1')
+    port = int(os.environ.get('PORT', 5000))
+    if app.config['SOCKETIO_ASYNC_MODE'] == 'threading':
+        socketio.run(app, host=host, port=port, allow_unsafe_werkzeug=True)
+    else:
+        socketio.run(app, host=host, port=port)
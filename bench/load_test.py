@@ -0,0 +1,149 @@
+"""In-process load test: N groups x M users trading and subscribed over Socket.IO.
+
+Drives the Flask app and the Socket.IO server through their test clients, so no ports or
+external processes are involved. Ticks are run back to back by calling market_tick directly
+instead of waiting on the wall-clock scheduler, and orders go through /place_order (or the
+place_order socket event) between ticks. Prints one JSON document with tick time, order
+latency, emit counts and payload bytes; compare two builds by diffing their outputs.
+
+    python bench/load_test.py --groups 4 --users 50 --ticks 30 --output before.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--users", type=int, default=50, help="Members per group")
+    parser.add_argument("--stocks", type=int, default=5, help="Stocks per group")
+    parser.add_argument("--ticks", type=int, default=30)
+    parser.add_argument("--orders-per-tick", type=int, default=20, help="Orders per group between two ticks")
+    parser.add_argument("--order-transport", choices=["http", "socket"], default="http")
+    parser.add_argument("--freq", default="1min", help="Candle frequency of the details subscriptions")
+    parser.add_argument("--mode", choices=["full", "delta"], default="full", help="Details subscription mode")
+    parser.add_argument("--top-n", type=int, default=10, help="Leaderboard size of each subscription")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    return parser.parse_args()
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def main():
+    args = parse_args()
+    # The benchmark owns its state: no journal, no recovered sessions
+    os.environ.pop("JOURNAL_DIR", None)
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import app
+    from routes import trading
+    logging.getLogger().setLevel(logging.WARNING)
+
+    http = app.app.test_client()
+    db = app.db.db_instance
+    rng = random.Random(args.seed)
+    stock_list = [f"S{i}" for i in range(args.stocks)]
+
+    # Setup, not measured: users, groups, memberships and one socket per member
+    records = [{"id": f"BU{g}_{u}", "phone": f"bench-{g}-{u}", "name": f"bench {g}/{u}", "password": "bench"}
+               for g in range(args.groups) for u in range(args.users)]
+    http.post("/registerBulk", json={"users": records})
+    group_ids, members = [], {}
+    for g in range(args.groups):
+        creator = f"BU{g}_0"
+        response = http.post("/createGroup", json={
+            "name": f"bench {g}", "creator_id": creator, "stock_list": stock_list,
+            "per_user_coins": 100000, "duration": args.ticks + 1, "seed": args.seed + g})
+        group_id = response.get_json()["group_id"]
+        group_ids.append(group_id)
+        members[group_id] = [f"BU{g}_{u}" for u in range(args.users)]
+        for user_id in members[group_id][1:]:
+            http.post("/joinGroup", json={"group_id": group_id, "user_id": user_id})
+
+    clients = []
+    for group_id in group_ids:
+        for user_id in members[group_id]:
+            client = app.socketio.test_client(app.app, flask_test_client=http)
+            client.emit("join_group", {"group_id": group_id, "user_id": user_id})
+            client.emit("join_group_details", {"group_id": group_id, "user_id": user_id, "freq": args.freq, "mode": args.mode})
+            client.emit("join_group_leaderboard", {"group_id": group_id, "user_id": user_id, "top_n": args.top_n})
+            clients.append(client)
+    for group_id in group_ids:
+        db.being_session(group_id)
+    for client in clients:
+        client.get_received()
+
+    tick_times, order_times = [], []
+    orders = {"FILLED": 0, "REJECTED": 0}
+    emits, emit_bytes, by_event = 0, 0, {}
+    order_client = {user_id: client for client, user_id in zip(clients, (u for g in group_ids for u in members[g]))}
+    started = time.perf_counter()
+    for _ in range(args.ticks):
+        for group_id in group_ids:
+            for _ in range(args.orders_per_tick):
+                order = {"group_id": group_id, "user_id": rng.choice(members[group_id]), "stock": rng.choice(stock_list),
+                         "quantity": rng.randint(1, 20), "direction": rng.choice(["BUY", "SELL"])}
+                t0 = time.perf_counter()
+                if args.order_transport == "http":
+                    filled = http.post("/place_order", json=order).status_code == 200
+                else:
+                    filled = order_client[order["user_id"]].emit("place_order", order, callback=True)["status"] == "FILLED"
+                order_times.append(time.perf_counter() - t0)
+                orders["FILLED" if filled else "REJECTED"] += 1
+            t0 = time.perf_counter()
+            trading.market_tick(group_id)
+            tick_times.append(time.perf_counter() - t0)
+        for client in clients:
+            for packet in client.get_received():
+                size = len(json.dumps(packet["args"]))
+                emits += 1
+                emit_bytes += size
+                stats = by_event.setdefault(packet["name"], {"count": 0, "bytes": 0})
+                stats["count"] += 1
+                stats["bytes"] += size
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "config": vars(args),
+        "wall_seconds": elapsed,
+        "ticks": percentiles(tick_times),
+        "orders": {**percentiles(order_times), **{k.lower(): v for k, v in orders.items()}},
+        "emits": {
+            "count": emits,
+            "bytes": emit_bytes,
+            "per_tick": emits / max(len(tick_times), 1),
+            "per_second_of_tick_time": emits / max(sum(tick_times), 1e-9),
+            "bytes_per_emit": emit_bytes / max(emits, 1),
+            "by_event": by_event,
+        },
+    }
+    output = json.dumps(report, indent=2, default=str)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+from functools import lru_cache
+
+import numpy as np
+from pandas.tseries.frequencies import to_offset
+
+DAY_SECONDS = 86400
+
+
+@lru_cache(maxsize=None)
+def freq_to_seconds(freq: str) -> int:
+    """Converts a pandas frequency string ('5s', '1min', '1h', ...) into whole seconds."""
+    try:
+        nanos = to_offset(freq).nanos
+    except ValueError:
+        raise ValueError(f"Unsupported candle frequency: {freq}")
+    if nanos < 1_000_000_000 or nanos % 1_000_000_000:
+        raise ValueError(f"Candle frequency must be a whole number of seconds: {freq}")
+    return nanos // 1_000_000_000
+
+
+class CandleBuilder:
+    """Streaming OHLC bars for one stock at one frequency.
+
+    Bars are bucketed the same way as pandas resample(freq).ohlc() with its default
+    start_day origin, so the output matches the old per-call resample. Each update only
+    touches the current bar.
+    """
+
+    def __init__(self, freq: str, started_at: int):
+        self.freq = freq
+        self.period = freq_to_seconds(freq)
+        self.origin = started_at - started_at % DAY_SECONDS
+        self.bars = []
+        self.opened = False
+
+    def update(self, timestamp: int, price: float):
+        bucket = self.origin + (timestamp - self.origin) // self.period * self.period
+        if self.bars and self.bars[-1]["timestamp"] == bucket:
+            bar = self.bars[-1]
+            if price > bar["high"]:
+                bar["high"] = price
+            if price < bar["low"]:
+                bar["low"] = price
+            bar["close"] = price
+            self.opened = False
+        else:
+            self.bars.append({"open": price, "high": price, "low": price, "close": price, "timestamp": bucket})
+            self.opened = True
+
+    def extend(self, started_at: int, prices, start: int = 0):
+        """Same as calling update for each price, reducing whole bars at once over the (array) slice."""
+        prices = np.asarray(prices)
+        if not len(prices):
+            return
+        timestamps = started_at + start + np.arange(len(prices))
+        buckets = self.origin + (timestamps - self.origin) // self.period * self.period
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(prices)] - 1
+        highs = np.maximum.reduceat(prices, starts).tolist()
+        lows = np.minimum.reduceat(prices, starts).tolist()
+        opens, closes = prices[starts].tolist(), prices[ends].tolist()
+        merged = False
+        for i, bucket in enumerate(buckets[starts].tolist()):
+            if i == 0 and self.bars and self.bars[-1]["timestamp"] == bucket:
+                merged = True
+                bar = self.bars[-1]
+                bar["high"] = max(bar["high"], highs[0])
+                bar["low"] = min(bar["low"], lows[0])
+                bar["close"] = closes[0]
+            else:
+                self.bars.append({"open": opens[i], "high": highs[i], "low": lows[i], "close": closes[i], "timestamp": bucket})
+        # As after the last update: set only if the last price opened a new bar
+        self.opened = bool(ends[-1] == starts[-1] and not (merged and len(starts) == 1))
+
+    def to_records(self):
+        # Closed bars are never mutated again, only the live one needs copying
+        if not self.bars:
+            return []
+        return self.bars[:-1] + [dict(self.bars[-1])]
+
+    def delta(self):
+        """Bars touched by the last update: the live bar, preceded by the one it closed if a new bar opened."""
+        if not self.bars:
+            return []
+        if self.opened and len(self.bars) > 1:
+            return [self.bars[-2], dict(self.bars[-1])]
+        return [dict(self.bars[-1])]
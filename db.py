@@ -1,141 +1,525 @@
-import threading
+import heapq
+import math
+import pickle
 from datetime import datetime
-from typing import Dict, List
+from time import perf_counter
+from typing import Dict, List, Set
 
+from journal import Journal
+from metrics import TimedRLock, TICK_PHASE_SECONDS
 from models import User, Group, Trade, OpenPosition, RoundTrip, UserDataPerSession
+from orderbook import PendingOrder, LIMIT, STOP, OPEN, FILLED, REJECTED, CANCELLED, EXPIRED
+from utils import MU, SIGMA
+
+
+def _positive_number(value) -> bool:
+    # JSON bodies can carry true, NaN and Infinity, none of which is a usable quantity or price
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) and value > 0
+
+
+class OrderRejected(ValueError):
+    """An order failed validation; status is the HTTP code the single-order route answers with."""
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
 
 
 class InMemoryDB:
+    """Users and groups held in memory.
+
+    Locking: `lock` only guards the user and group registries and is held briefly. Everything
+    inside a group (prices, candles, members, trades) is owned by that group's own lock, so
+    independent groups tick and trade in parallel. Never acquire a group lock while holding `lock`.
+
+    Durability: when a Journal is attached, every mutation appends a record while still holding the
+    lock that guards it. A snapshot can then tag each group (and the registry) with the lsn it was
+    taken at, and restore() replays only the records newer than that.
+    """
     def __init__(self):
         self._users: Dict[str, User] = {}
         self._groups: Dict[str, Group] = {}
-        self.lock = threading.RLock()
+        self._user_ids_by_phone: Dict[str, str] = {}  # Unique phone -> user_id index
+        self._group_ids_by_user: Dict[str, Set[str]] = {}  # Membership: user_id -> group_ids
+        self._group_ids_by_state: Dict[str, Set[str]] = {"CREATED": set(), "STARTED": set(), "FINISHED": set()}
+        self._group_seq: Dict[str, int] = {}  # Creation order, used to list and page groups stably
+        self._group_order: List[str] = []  # group_ids indexed by their creation seq
+        self.lock = TimedRLock("registry")
+        self.journal: Journal = None
+
+    def _log(self, op: str, **args):
+        if self.journal is not None:
+            self.journal.append(op, **args)
 
     def add_user(self, user_id: str, phone: str, name: str, password: str):
         with self.lock:
+            owner = self._user_ids_by_phone.get(phone)
+            if owner is not None and owner != user_id:
+                raise ValueError("User with this phone number already exists")
+            previous = self._users.get(user_id)
+            if previous is not None and previous.phone != phone:
+                del self._user_ids_by_phone[previous.phone]
             self._users[user_id] = User(phone, name, password)
+            self._user_ids_by_phone[phone] = user_id
+            self._log("add_user", user_id=user_id, phone=phone, name=name, password=password)
+
+    def add_users(self, records: List[Dict]) -> List[str]:
+        """Imports many users under one lock acquisition.
+
+        Each record needs id, phone, name and password. Returns one error message per record,
+        None for the ones that were added. Records clashing on phone with an existing user or an
+        earlier record in the batch are rejected.
+        """
+        errors = []
+        added = []
+        with self.lock:
+            for record in records:
+                user_id, phone = record["id"], record["phone"]
+                if user_id in self._users:
+                    errors.append("User with this id already exists")
+                elif phone in self._user_ids_by_phone:
+                    errors.append("User with this phone number already exists")
+                else:
+                    self._users[user_id] = User(phone, record["name"], record["password"])
+                    self._user_ids_by_phone[phone] = user_id
+                    added.append({"id": user_id, "phone": phone, "name": record["name"], "password": record["password"]})
+                    errors.append(None)
+            if added:
+                self._log("add_users", records=added)
+        return errors
+
+    def get_user_id_by_phone(self, phone: str):
+        return self._user_ids_by_phone.get(phone)
 
     def get_user(self, phone: str):
         return self._users.get(phone)
 
-    def add_group(self, group_id: str, name: str, creator_id: str, stock_list, per_user_coins, duration):
+    def add_group(self, group_id: str, name: str, creator_id: str, stock_list, per_user_coins, duration, defer_prices=False, seed=None,
+                  mu=MU, sigma=SIGMA, scenario=None):
+        if creator_id not in self._users:
+            raise ValueError("Creator must be a registered user")
+        if group_id in self._groups:
+            raise ValueError("Group already exists")
+        # Price generation is the expensive part, so the group is built before taking the lock
+        group = Group(group_id, name, creator_id, stock_list, per_user_coins, duration, defer_prices, seed, mu, sigma, scenario)
         with self.lock:
-            if creator_id not in self._users:
-                raise ValueError("Creator must be a registered user")
-            group = Group(group_id, name, creator_id, stock_list, per_user_coins, duration)
-            self._groups[group_id] = group
-            return group
+            if group_id in self._groups:
+                raise ValueError("Group already exists")
+            self._register_group(group)
+            self._log("add_group", group_id=group_id, name=name, creator_id=creator_id, stock_list=stock_list,
+                      per_user_coins=per_user_coins, duration=duration, defer_prices=defer_prices, seed=group.seed,
+                      mu=mu, sigma=sigma, scenario=group.scenario)
+        self.join_group(group_id, creator_id)
+        return group
+
+    def _register_group(self, group: Group):
+        # Caller holds the registry lock
+        self._groups[group.group_id] = group
+        self._group_seq[group.group_id] = len(self._group_order)
+        self._group_order.append(group.group_id)
+        self._group_ids_by_state[group.state].add(group.group_id)
+        for user_id in group.user_data:
+            self._group_ids_by_user.setdefault(user_id, set()).add(group.group_id)
+
+    def _set_state(self, group: Group, state: str):
+        # Caller holds the group lock; the state index itself is guarded by the registry lock
+        with self.lock:
+            self._group_ids_by_state[group.state].discard(group.group_id)
+            self._group_ids_by_state[state].add(group.group_id)
+        group.state = state
+        group.version += 1
+
+    def _page(self, group_ids, after: int, limit: int):
+        """Groups from group_ids created after seq `after`, oldest first, plus the cursor of the next page."""
+        seqs = heapq.nsmallest(limit + 1, (seq for seq in map(self._group_seq.__getitem__, group_ids) if seq > after))
+        next_cursor = seqs[limit - 1] if len(seqs) > limit else None
+        return [self._groups[self._group_order[seq]] for seq in seqs[:limit]], next_cursor
+
+    def get_all_groups(self, after: int = -1, limit: int = None):
+        with self.lock:
+            limit = len(self._group_order) if limit is None else limit
+            page = self._group_order[after + 1:after + 1 + limit]
+            next_cursor = after + limit if after + 1 + limit < len(self._group_order) else None
+            return [self._groups[group_id] for group_id in page], next_cursor
+
+    def get_user_groups(self, user_id: str, after: int = -1, limit: int = None):
+        with self.lock:
+            group_ids = self._group_ids_by_user.get(user_id, ())
+            return self._page(group_ids, after, len(group_ids) if limit is None else limit)
+
+    def get_joinable_groups(self, user_id: str, after: int = -1, limit: int = None):
+        """Groups that are not finished and that user_id has not joined yet."""
+        with self.lock:
+            joined = self._group_ids_by_user.get(user_id, set())
+            open_group_ids = (self._group_ids_by_state["CREATED"] | self._group_ids_by_state["STARTED"]) - joined
+            return self._page(open_group_ids, after, len(open_group_ids) if limit is None else limit)
+
+    def get_group_view(self, group: Group, detail: str = "summary"):
+        with group.lock:
+            return group.to_dict() if detail == "full" else group.to_summary()
 
     def get_group(self, group_id: str):
         return self._groups.get(group_id)
 
+    def group_lock(self, group_id: str) -> TimedRLock:
+        return self._groups[group_id].lock
+
     def get_group_state(self, group_id: str) -> str:
-        with self.lock:
-            if group_id not in self._groups:
-                return None
-            return self._groups[group_id].state
+        group = self._groups.get(group_id)
+        if group is None:
+            return None
+        with group.lock:
+            return group.state
 
     def get_group_duration(self, group_id: str) -> str:
-        with self.lock:
+        with self.group_lock(group_id):
             return self._groups[group_id].duration
 
-    def being_session(self, group_id: str) -> str:
-        with self.lock:
-            self._groups[group_id].state = "STARTED"
-            self._groups[group_id].started_at = int(datetime.now().timestamp())
+    def being_session(self, group_id: str, started_at: int = None) -> bool:
+        # Deferred groups generate their price series here, still outside the lock
+        self._groups[group_id].generate_prices()
+        with self.group_lock(group_id):
+            if self._groups[group_id].state != "CREATED":
+                return False
+            self._set_state(self._groups[group_id], "STARTED")
+            self._groups[group_id].started_at = started_at or int(datetime.now().timestamp())
+            self._groups[group_id].portfolio.mark(self._groups[group_id].current_prices())
+            self._log("begin_session", group_id=group_id, started_at=self._groups[group_id].started_at)
+            return True
+
+    def end_session(self, group_id: str, ended_at: int = None) -> List[Dict]:
+        """Finishes the session and returns the resting orders it expired."""
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            self._set_state(group, "FINISHED")
+            group.ended_at = ended_at or int(datetime.now().timestamp())
+            expired = group.orders.open_orders()
+            for order in expired:
+                group.orders.close(order, EXPIRED)
+            group.offload_prices()
+            self._log("end_session", group_id=group_id, ended_at=group.ended_at)
+            return [order.to_dict() for order in expired]
 
-    def end_session(self, group_id: str) -> str:
+    def get_started_sessions(self) -> Dict[str, int]:
+        """Ticks left for every running session, used to resume them after a restart."""
         with self.lock:
-            self._groups[group_id].state = "FINISHED"
-            self._groups[group_id].ended_at = int(datetime.now().timestamp())
+            started = [self._groups[group_id] for group_id in self._group_ids_by_state["STARTED"]]
+        return {group.group_id: group.duration - group.active_duration for group in started}
 
     def simulate(self, group_id: str) -> Dict[str, float]:
-        with self.lock:
+        with self.group_lock(group_id):
             prices = {}
-            for stock in self._groups[group_id].stocks.values():
-                prices[stock.id] = stock.prices_per_second[self._groups[group_id].active_duration]
+            for stock_id in self._groups[group_id].stocks:
+                prices[stock_id] = self._groups[group_id].current_price(stock_id)
 
             self._groups[group_id].active_duration += 1
+            self._groups[group_id].update_candles()
+            marked = perf_counter()
             self._update_pnl(self._groups[group_id])
+            TICK_PHASE_SECONDS.observe(perf_counter() - marked, "update_pnl")
+            self._groups[group_id].version += 1
+            self._log("tick", group_id=group_id, active_duration=self._groups[group_id].active_duration)
             return prices
 
     def get_stock_prices(self, group_id: str, stock_id: str) -> float:
-        with self.lock:
+        with self.group_lock(group_id):
             if stock_id not in self._groups[group_id].stocks:
                 return None
-            return self._groups[group_id].stocks[stock_id].prices_per_second[self._groups[group_id].active_duration]
+            return self._groups[group_id].current_price(stock_id)
 
     def get_stock_price_series(self, group_id: str, stock_id: str, freq: str) -> Dict:
-        with self.lock:
-            price = self._groups[group_id].to_ohlc_candles(stock_id, freq)
-            ohlc_json = price.reset_index()
-            ohlc_json["timestamp"] = ohlc_json["index"].astype("int64") // 1_000_000_000
-            ohlc_json = ohlc_json.drop(columns=["index"])
-            return ohlc_json.to_dict(orient="records")
+        with self.group_lock(group_id):
+            if stock_id not in self._groups[group_id].stocks:
+                return None
+            return self._groups[group_id].to_ohlc_candles(stock_id, freq)
+
+    def get_stock_price_delta(self, group_id: str, stock_id: str, freq: str) -> List[Dict]:
+        with self.group_lock(group_id):
+            return self._groups[group_id].ohlc_candles_delta(stock_id, freq)
+
+    def get_price_snapshot(self, group_id: str, freq: str) -> Dict:
+        """Full candle history of every stock, tagged with the tick it was taken at."""
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            stocks = {}
+            if group.started_at is not None:
+                for stock_id in group.stocks:
+                    stocks[stock_id] = {
+                        "ltp": group.current_price(stock_id),
+                        "candles": group.to_ohlc_candles(stock_id, freq),
+                    }
+            return {"seq": group.active_duration, "stocks": stocks}
+
+    def get_group_tick(self, group_id: str) -> int:
+        with self.group_lock(group_id):
+            return self._groups[group_id].active_duration
 
     def get_stocks(self, group_id: str) -> List[str]:
-        with self.lock:
-            if group_id not in self._groups:
-                return None
+        if group_id not in self._groups:
+            return None
+        with self.group_lock(group_id):
             return [k for k, v in self._groups[group_id].stocks.items()]
 
     def get_user_positions(self, group_id: str, user_id: str):
-        with self.lock:
-            if group_id not in self._groups:
-                return None
+        if group_id not in self._groups:
+            return None
+        with self.group_lock(group_id):
             group = self._groups[group_id]
             if user_id not in group.user_data:
                 return None
             user = group.user_data[user_id]
+            user.refresh_positions()
             return {
-                "open_positions": user.open_positions,
+                "open_positions": list(user.open_positions.values()),
                 "closed_positions": user.roundtrips,
             }
 
-    def get_leaderboard(self, group_id: str):
-        with self.lock:
-            leaderboard = []
-            for user_id, user_data in groups[group_id].user_data.items():
-                leaderboard.append({"user_id": user_id, "user_name": users[user_id].name , "mtm": user_data.mtm})
-            sorted_leaderboard = sorted(leaderboard, key=lambda item: item["mtm"], reverse=True)
-            return sorted_leaderboard
+    def get_leaderboard(self, group_id: str, top_n: int = None):
+        with self.group_lock(group_id):
+            return [
+                {"user_id": user_id, "user_name": self._users[user_id].name, "mtm": mtm}
+                for user_id, mtm in self._groups[group_id].leaderboard.top(top_n)
+            ]
+
+    def get_leaderboard_rank(self, group_id: str, user_id: str):
+        with self.group_lock(group_id):
+            leaderboard = self._groups[group_id].leaderboard
+            rank = leaderboard.rank(user_id)
+            if rank is None:
+                return None
+            return {"user_id": user_id, "user_name": self._users[user_id].name, "mtm": leaderboard.mtm(user_id),
+                    "rank": rank, "of": len(leaderboard)}
+
+    def get_leaderboard_version(self, group_id: str) -> int:
+        with self.group_lock(group_id):
+            return self._groups[group_id].leaderboard.version
 
     def get_user_available_coins(self, group_id: str, user_id: str):
-        with self.lock:
+        with self.group_lock(group_id):
             user = self._groups[group_id].user_data[user_id]
             return user.available_coins
 
-    def execute_trade(self, user_id: str, stock: str, quantity: int, price: float, direction: str, group_id: str):
-        with self.lock:
+    def _validate_order(self, group: Group, user_id: str, stock: str, quantity, direction: str, coins: float, holdings) -> float:
+        """Checks one market order against the given coins/holdings and returns its fill price.
+
+        Caller holds the group lock. Raises OrderRejected with the same messages /place_order uses.
+        """
+        if group.state != "STARTED":
+            raise OrderRejected("Session is not active")
+        if user_id not in group.user_data:
+            raise OrderRejected("User is not a member of this group", 404)
+        if not _positive_number(quantity):
+            raise OrderRejected("Quantity must be positive")
+        if direction not in ['BUY', 'SELL']:
+            raise OrderRejected("Direction must be either BUY or SELL")
+        if stock not in group.stocks:
+            raise OrderRejected("Stock not found", 404)
+        price = group.current_price(stock)
+        if direction == 'SELL':
+            if not holdings or holdings < quantity:
+                raise OrderRejected("Insufficient stock to sell")
+        elif coins < price * quantity:
+            raise OrderRejected("Insufficient margin")
+        return price
+
+    def place_order(self, group_id: str, user_id: str, stock: str, quantity, direction: str) -> Dict:
+        """Validates and executes one market order in a single group-lock critical section.
+
+        The order fills at the price it was validated against, since no tick can land in between.
+        Returns {"price", "available_coins"}; raises OrderRejected if the order is invalid.
+        """
+        group = self._groups.get(group_id)
+        if group is None:
+            raise OrderRejected("Group not found", 404)
+        with group.lock:
+            user = group.user_data.get(user_id)
+            coins, holdings = None, None
+            if user is not None:
+                op = user.open_positions.get(stock)
+                coins, holdings = user.available_coins, op.quantity if op else 0
+            price = self._validate_order(group, user_id, stock, quantity, direction, coins, holdings)
+            self.execute_trade(user_id, stock, quantity, price, direction, group_id)
+            return {"price": price, "available_coins": user.available_coins}
+
+    def place_orders(self, group_id: str, orders: List[Dict], atomic: bool = False) -> List[Dict]:
+        """Validates and executes a batch of market orders under one group-lock acquisition.
+
+        Every order is priced at the same tick. Each order dict has user_id, stock, quantity and
+        direction. Returns one result per order: {"status": "FILLED", "price": ...} or
+        {"status": "REJECTED", "error": ...}. With atomic=True, orders are validated in sequence
+        against the state the earlier orders would leave, and nothing executes unless all pass.
+        """
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            coins, holdings = {}, {}
+            results = []
+            for order in orders:
+                user_id, stock = order.get("user_id"), order.get("stock")
+                quantity, direction = order.get("quantity"), order.get("direction")
+                user = group.user_data.get(user_id)
+                if user_id not in coins and user is not None:
+                    coins[user_id] = user.available_coins
+                key = (user_id, stock)
+                if key not in holdings and user is not None:
+                    op = user.open_positions.get(stock)
+                    holdings[key] = op.quantity if op else 0
+                try:
+                    price = self._validate_order(group, user_id, stock, quantity, direction, coins.get(user_id), holdings.get(key))
+                except OrderRejected as e:
+                    results.append({"status": "REJECTED", "error": str(e)})
+                    continue
+                sign = 1 if direction == "BUY" else -1
+                coins[user_id] -= sign * price * quantity
+                holdings[key] += sign * quantity
+                results.append({"status": "FILLED", "price": price})
+
+            if atomic and any(result["status"] == "REJECTED" for result in results):
+                return [result if result["status"] == "REJECTED" else {"status": "REJECTED", "error": "Batch rejected"}
+                        for result in results]
+            for order, result in zip(orders, results):
+                if result["status"] == "FILLED":
+                    self.execute_trade(order["user_id"], order["stock"], order["quantity"], result["price"], order["direction"], group_id)
+            return results
+
+    def place_pending_order(self, group_id: str, user_id: str, stock: str, quantity, direction: str, order_type: str,
+                            trigger_price, order_id: str = None) -> Dict:
+        """Rests a LIMIT or STOP order in the group's order book until a tick price crosses trigger_price.
+
+        Margin and holdings are only checked when the order fires. Raises OrderRejected if the order
+        itself is invalid.
+        """
+        group = self._groups.get(group_id)
+        if group is None:
+            raise OrderRejected("Group not found", 404)
+        with group.lock:
+            if group.state == "FINISHED":
+                raise OrderRejected("Session is not active")
+            if user_id not in group.user_data:
+                raise OrderRejected("User is not a member of this group", 404)
+            if not _positive_number(quantity):
+                raise OrderRejected("Quantity must be positive")
+            if direction not in ['BUY', 'SELL']:
+                raise OrderRejected("Direction must be either BUY or SELL")
+            if order_type not in [LIMIT, STOP]:
+                raise OrderRejected("Order type must be MARKET, LIMIT or STOP")
+            if not _positive_number(trigger_price):
+                raise OrderRejected("Trigger price must be positive")
+            if stock not in group.stocks:
+                raise OrderRejected("Stock not found", 404)
+            order = PendingOrder(order_id or group.orders.next_order_id(), user_id, stock, quantity, direction,
+                                 order_type, trigger_price)
+            group.orders.add(order)
+            self._log("place_pending_order", group_id=group_id, user_id=user_id, stock=stock, quantity=quantity,
+                      direction=direction, order_type=order_type, trigger_price=trigger_price, order_id=order.order_id)
+            return order.to_dict()
+
+    def _open_order(self, group: Group, user_id: str, order_id: str) -> PendingOrder:
+        order = group.orders.orders.get(order_id)
+        if order is None or order.user_id != user_id:
+            raise OrderRejected("Order not found", 404)
+        if order.status != OPEN:
+            raise OrderRejected(f"Order is already {order.status}")
+        return order
+
+    def cancel_order(self, group_id: str, user_id: str, order_id: str) -> Dict:
+        group = self._groups.get(group_id)
+        if group is None:
+            raise OrderRejected("Group not found", 404)
+        with group.lock:
+            order = self._open_order(group, user_id, order_id)
+            group.orders.close(order, CANCELLED)
+            self._log("cancel_order", group_id=group_id, user_id=user_id, order_id=order_id)
+            return order.to_dict()
+
+    def modify_order(self, group_id: str, user_id: str, order_id: str, quantity=None, trigger_price=None) -> Dict:
+        """Changes the quantity and/or trigger price of a resting order, keeping its order_id."""
+        group = self._groups.get(group_id)
+        if group is None:
+            raise OrderRejected("Group not found", 404)
+        with group.lock:
+            order = self._open_order(group, user_id, order_id)
+            if quantity is not None and not _positive_number(quantity):
+                raise OrderRejected("Quantity must be positive")
+            if trigger_price is not None and not _positive_number(trigger_price):
+                raise OrderRejected("Trigger price must be positive")
+            if quantity is not None:
+                order.quantity = quantity
+            if trigger_price is not None and trigger_price != order.trigger_price:
+                group.orders.reprice(order, trigger_price)
+            self._log("modify_order", group_id=group_id, user_id=user_id, order_id=order_id, quantity=quantity,
+                      trigger_price=trigger_price)
+            return order.to_dict()
+
+    def get_orders(self, group_id: str, user_id: str) -> List[Dict]:
+        with self.group_lock(group_id):
+            return [order.to_dict() for order in self._groups[group_id].orders.for_user(user_id)]
+
+    def trigger_orders(self, group_id: str) -> List[Dict]:
+        """Fills the resting orders crossed by the current price and returns them, filled or rejected.
+
+        Only the crossed heap entries are looked at. Each fired order is validated like a market
+        order at the current price and goes through execute_trade.
+        """
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            if group.state != "STARTED" or not group.orders.open:
+                return []
+            done = []
+            for stock_id in group.stocks:
+                price = group.current_price(stock_id)
+                for order in group.orders.triggered(stock_id, price):
+                    user = group.user_data[order.user_id]
+                    op = user.open_positions.get(order.stock)
+                    try:
+                        self._validate_order(group, order.user_id, order.stock, order.quantity, order.direction,
+                                             user.available_coins, op.quantity if op else 0)
+                    except OrderRejected as e:
+                        order.error = str(e)
+                        self._complete_order(group, order, REJECTED)
+                    else:
+                        self.execute_trade(order.user_id, order.stock, order.quantity, price, order.direction, group_id)
+                        order.fill_price = price
+                        self._complete_order(group, order, FILLED)
+                    done.append(order.to_dict())
+            return done
+
+    def _complete_order(self, group: Group, order: PendingOrder, status: str):
+        group.orders.close(order, status)
+        self._log("complete_order", group_id=group.group_id, order_id=order.order_id, status=status,
+                  fill_price=order.fill_price, error=order.error)
+
+    def execute_trade(self, user_id: str, stock: str, quantity: int, price: float, direction: str, group_id: str, timestamp: datetime = None):
+        with self.group_lock(group_id):
             group = self._groups[group_id]
-            trade = Trade(user_id, stock, quantity, price, direction)
+            trade = Trade(user_id, stock, quantity, price, direction, timestamp)
             group.user_data[user_id].trades.append(trade)
             self._handle_position(group, user_id, trade)
             self._handle_coins(group, user_id, trade)
+            group.user_data[user_id].version += 1
+            group.version += 1
+            self._log("execute_trade", user_id=user_id, stock=stock, quantity=quantity, price=price, direction=direction,
+                      group_id=group_id, timestamp=trade.timestamp.isoformat())
 
     def _handle_position(self, group: Group, user_id: str, trade: Trade):
         user_data = group.user_data[user_id]
+        position = user_data.open_positions.get(trade.stock)
         if trade.direction == "BUY":
-            existing_position = next((pos for pos in user_data.open_positions if pos.stock == trade.stock), None)
-            if existing_position:
-                existing_position.quantity += trade.quantity
-                existing_position.entry_price = ((existing_position.entry_price * existing_position.quantity) + (trade.price * trade.quantity)) / (existing_position.quantity + trade.quantity)
+            if position:
+                position.entry_price = ((position.entry_price * position.quantity) + (trade.price * trade.quantity)) / (position.quantity + trade.quantity)
+                position.quantity += trade.quantity
             else:
-                position = OpenPosition(user_id, trade.stock, trade.quantity, trade.price, trade.timestamp, "BUY")
-                user_data.open_positions.append(position)
-        elif trade.direction == "SELL":
-            for position in user_data.open_positions:
-                if position.stock == trade.stock:
-                    round_trip = RoundTrip(
-                        user_id, trade.stock, trade.quantity, position.entry_price, position.entry_time,
-                        trade.price, trade.timestamp, position.direction
-                    )
-                    user_data.roundtrips.append(round_trip)
-                    if position.quantity > trade.quantity:
-                        position.quantity -= trade.quantity
-                    else:
-                        user_data.open_positions.remove(position)
-                    break  # Assume we match only one position per trade
+                user_data.open_positions[trade.stock] = OpenPosition(user_id, trade.stock, trade.quantity, trade.price, trade.timestamp, "BUY")
+            group.portfolio.buy(user_id, trade.stock, trade.quantity, trade.price)
+        elif trade.direction == "SELL" and position:
+            round_trip = RoundTrip(
+                user_id, trade.stock, trade.quantity, position.entry_price, position.entry_time,
+                trade.price, trade.timestamp, position.direction
+            )
+            user_data.roundtrips.append(round_trip)
+            if position.quantity > trade.quantity:
+                position.quantity -= trade.quantity
+            else:
+                del user_data.open_positions[trade.stock]
+            group.portfolio.sell(user_id, trade.stock, trade.quantity, trade.price)
 
     def _handle_coins(self, group: Group, user_id: str, trade: Trade):
         if trade.direction == "BUY":
@@ -144,54 +528,155 @@ class InMemoryDB:
             group.user_data[user_id].available_coins += trade.price * trade.quantity
 
     def _update_pnl(self, group: Group):
-        for user in group.user_data.values():
-            for op in user.open_positions:
-                op.current_price = group.stocks[op.stock].prices_per_second[group.active_duration]
-                op.update_pnl()
-            user.update_mtm()
+        group.portfolio.mark(group.current_prices())
+        group.leaderboard.update_many(group.portfolio.mtm_by_user())
 
     def get_pnl(self, group_id: str, user_id: str):
-        with self.lock:
-            data = {  }
-            for stock in self._groups[group_id].stocks.keys():
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            user = group.user_data[user_id]
+            portfolio = group.portfolio
+            unrealized = portfolio.unrealized[user.row].tolist()
+            realized = portfolio.realized[user.row].tolist()
+            data = {}
+            for stock, col in portfolio.stock_index.items():
+                op = user.open_positions.get(stock)
                 data[stock] = {
-                    "holdings": 0,
-                    "unrealized_pnl": 0,
-                    "realized_pnl": 0,
+                    "holdings": op.quantity if op else 0,
+                    "unrealized_pnl": unrealized[col] if op else 0,
+                    "realized_pnl": realized[col],
                 }
-            user = self._groups[group_id].user_data[user_id]
-            for op in user.open_positions:
-                data[op.stock]["holdings"] = op.quantity
-                data[op.stock]["unrealized_pnl"] = op.pnl
-                data[op.stock]["op"] = op.to_dict()
-            for rt in user.roundtrips:
-                data[rt.stock]["realized_pnl"] += rt.pnl
+                if op:
+                    op.current_price = float(portfolio.prices[col])
+                    op.pnl = unrealized[col]
+                    data[stock]["op"] = op.to_dict()
             return data
 
     def get_margin(self, group_id: str, user_id: str):
-        with self.lock:
+        with self.group_lock(group_id):
             data = {  }
             data["available_coins"] = self._groups[group_id].user_data[user_id].available_coins
             return data
 
-    def join_group(self, group_id: str, user_id: str):
-        with self.lock:
-            self._groups[group_id].user_data[user_id] = UserDataPerSession(self._groups[group_id].per_user_coins)
+    def join_group(self, group_id: str, user_id: str) -> bool:
+        with self.group_lock(group_id):
+            group = self._groups[group_id]
+            if user_id in group.user_data:
+                return False
+            group.user_data[user_id] = UserDataPerSession(group.per_user_coins, group.portfolio, user_id)
+            group.leaderboard.add(user_id)
+            group.version += 1
+            self._log("join_group", group_id=group_id, user_id=user_id)
+            with self.lock:
+                self._group_ids_by_user.setdefault(user_id, set()).add(group_id)
+            return True
+
+    def get_group_version(self, group_id: str) -> int:
+        """Moves on every tick, trade, join and state change of the group."""
+        return self._groups[group_id].version
+
+    def get_user_version(self, group_id: str, user_id: str) -> int:
+        """Moves on every trade of user_id in the group."""
+        return self._groups[group_id].user_data[user_id].version
+
+    def get_group_details(self, group_id: str):
+        with self.group_lock(group_id):
+            return self._groups[group_id].to_dict()
 
     def check_user(self, group_id: str, user_id: str):
-        with self.lock:
+        with self.group_lock(group_id):
             return user_id in self._groups[group_id].user_data
 
+    def snapshot_state(self) -> Dict:
+        """Picklable copy of every user and group, each tagged with the journal lsn it was taken at."""
+        with self.lock:
+            registry_lsn = self.journal.lsn
+            users = dict(self._users)
+            group_order = list(self._group_order)
+        groups = {}
+        for group_id in group_order:
+            group = self._groups[group_id]
+            with group.lock:
+                groups[group_id] = (self.journal.lsn, pickle.dumps(group, protocol=pickle.HIGHEST_PROTOCOL))
+        return {"lsn": self.journal.lsn, "registry_lsn": registry_lsn, "users": users, "group_order": group_order, "groups": groups}
+
+    def restore(self, snapshot: Dict, records: List[Dict]):
+        """Rebuilds state from snapshot_state() output (or None) and the journal records after it."""
+        registry_lsn, group_lsns = 0, {}
+        if snapshot is not None:
+            registry_lsn = snapshot["registry_lsn"]
+            with self.lock:
+                for user_id, user in snapshot["users"].items():
+                    self._users[user_id] = user
+                    self._user_ids_by_phone[user.phone] = user_id
+                for group_id in snapshot["group_order"]:
+                    group_lsns[group_id], data = snapshot["groups"][group_id]
+                    self._register_group(pickle.loads(data))
+        for record in records:
+            group_id = record["args"].get("group_id")
+            if record["op"] in ("add_user", "add_users", "add_group"):
+                if record["lsn"] <= registry_lsn:
+                    continue
+            elif record["lsn"] <= group_lsns.get(group_id, 0):
+                continue
+            self._apply(record["op"], record["args"])
+
+    def _apply(self, op: str, args: Dict):
+        if op == "add_user":
+            self.add_user(**args)
+        elif op == "add_users":
+            self.add_users(args["records"])
+        elif op == "add_group":
+            self.add_group(**args)
+        elif op == "join_group":
+            self.join_group(**args)
+        elif op == "begin_session":
+            self.being_session(**args)
+        elif op == "end_session":
+            self.end_session(**args)
+        elif op == "tick":
+            if self._groups[args["group_id"]].active_duration < args["active_duration"]:
+                self.simulate(args["group_id"])
+        elif op == "execute_trade":
+            self.execute_trade(**{**args, "timestamp": datetime.fromisoformat(args["timestamp"])})
+        elif op == "place_pending_order":
+            self.place_pending_order(**args)
+        elif op == "cancel_order":
+            self.cancel_order(**args)
+        elif op == "modify_order":
+            self.modify_order(**args)
+        elif op == "complete_order":
+            # The fill itself was journaled as its own execute_trade record
+            group = self._groups[args["group_id"]]
+            order = group.orders.orders[args["order_id"]]
+            order.fill_price, order.error = args["fill_price"], args["error"]
+            group.orders.close(order, args["status"])
+        else:
+            raise ValueError(f"Unknown journal record: {op}")
+
 db_instance = InMemoryDB()
 users = db_instance._users
 groups = db_instance._groups
 
 
+def init_durable(directory: str, data, flush_interval: float, snapshot_interval: float, run_blocking=None):
+    """Recovers from the journal in directory, or seeds from data when it holds no state yet."""
+    journal = Journal(directory, flush_interval, run_blocking)
+    snapshot, records = journal.load()
+    db_instance.restore(snapshot, records)
+    journal.start()
+    db_instance.journal = journal
+    if snapshot is None and not records:
+        init(data)
+    journal.start_snapshots(lambda lsn: db_instance.snapshot_state(), snapshot_interval)
+    return journal
+
+
 def init(data):
-    for user in data["users"]:
-        db_instance.add_user(user["id"], user["phone"], user["name"], user["password"])
+    for user, error in zip(data["users"], db_instance.add_users(data["users"])):
+        if error:
+            raise ValueError(f"{user['id']}: {error}")
     for group in data["groups"]:
         db_instance.add_group(group["id"], group["name"], group["creator_id"], group["stock_list"], group["per_user_coins"], group["duration"])
-        groups.get(group["id"]).user_data[group["creator_id"]] = UserDataPerSession(group["per_user_coins"])
         for user_id in group["joinies"]:
-            groups.get(group["id"]).user_data[user_id] = UserDataPerSession(group["per_user_coins"])
\ No newline at end of file
+            db_instance.join_group(group["id"], user_id)
@@ -1,13 +1,47 @@
+import os
+
 from flask import Flask
 from flask_socketio import SocketIO
 from flasgger import Swagger
 
+from metrics import MeteredPacket
+from response_cache import ResponseCache
+from scheduler import TickScheduler
+
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")  # Allow all origins for local dev
+# "threading" serves each websocket from its own OS thread. "gevent" runs every connection, tick
+# and journal thread as a greenlet, once app.py has monkey-patched the standard library.
+app.config['SOCKETIO_ASYNC_MODE'] = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=app.config['SOCKETIO_ASYNC_MODE'])  # Allow all origins for local dev
+# Counts outgoing events and their encoded bytes for /metrics
+socketio.server.packet_class = MeteredPacket
 
 app.config['SWAGGER'] = {
     'title': 'Trading API',
     'uiversion': 3,
     'specs_route': '/apidocs/'
 }
-swagger = Swagger(app)
\ No newline at end of file
+swagger = Swagger(app)
+
+# One scheduler drives the ticks of every running session
+app.config['TICK_WORKERS'] = int(os.environ.get('TICK_WORKERS', 4))
+app.config['TICK_OVERRUN_POLICY'] = os.environ.get('TICK_OVERRUN_POLICY', 'skip')
+scheduler = TickScheduler(workers=app.config['TICK_WORKERS'], policy=app.config['TICK_OVERRUN_POLICY'])
+
+# Durable state: journal + snapshots are only kept when JOURNAL_DIR is set
+app.config['JOURNAL_DIR'] = os.environ.get('JOURNAL_DIR')
+app.config['JOURNAL_FLUSH_INTERVAL'] = float(os.environ.get('JOURNAL_FLUSH_INTERVAL', 0.05))
+app.config['SNAPSHOT_INTERVAL'] = float(os.environ.get('SNAPSHOT_INTERVAL', 300))
+
+# Price series storage, see price_store.PriceStore
+app.config['PRICE_DTYPE'] = os.environ.get('PRICE_DTYPE', 'float64')
+app.config['PRICE_MMAP_DIR'] = os.environ.get('PRICE_MMAP_DIR')
+app.config['PRICE_MMAP_MIN_POINTS'] = int(os.environ.get('PRICE_MMAP_MIN_POINTS', 1_000_000))
+app.config['PRICE_PATH_CACHE_SIZE'] = int(os.environ.get('PRICE_PATH_CACHE_SIZE', 64))  # Scenarios kept, see price_paths
+
+# Set by router.py on the worker processes it spawns; a shard only owns the groups shard_for assigns it
+app.config['SHARD_INDEX'] = int(os.environ.get('SHARD_INDEX', 0))
+app.config['SHARD_COUNT'] = int(os.environ.get('SHARD_COUNT', 1))
+
+# Serialized responses of polled GET routes, keyed by group/user version
+response_cache = ResponseCache()
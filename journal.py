@@ -0,0 +1,158 @@
+import glob
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+
+SNAPSHOT_FILE = "snapshot.bin"
+SEGMENT_PATTERN = "journal.*.log"
+
+
+class Journal:
+    """Append-only log of InMemoryDB mutations plus periodic snapshots, kept in one directory.
+
+    append() only assigns a sequence number (lsn) and buffers the record, so callers never wait on
+    the disk. A flusher thread writes the buffer and fsyncs it every `flush_interval` seconds.
+    `_lock` only guards the lsn and the buffer; the file is written under `_io_lock`, so an append
+    never waits for an fsync in progress.
+    Records go to journal.<first lsn>.log segments. Each snapshot starts a new segment, and the
+    older segments are deleted once the snapshot is safely on disk. load() returns the latest
+    snapshot and every record written after the segment it started from. The caller decides,
+    per record, whether the snapshot already contains it.
+
+    File writes and fsyncs go through `run_blocking(fn, args)`, which by default just calls fn.
+    Under gevent the flusher is a greenlet, so the app passes the hub's threadpool to keep fsync
+    off the event loop.
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 0.05, run_blocking=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.run_blocking = run_blocking or (lambda fn, args: fn(*args))
+        self.lsn = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._file = None
+        self._segment = None
+        self._flusher = None
+        self._snapshotter = None
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """Returns (snapshot or None, records) and positions the journal after the last record."""
+        snapshot = None
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+            self.lsn = snapshot["lsn"]
+        records = []
+        for segment in self._segments():
+            with open(segment, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write can only be the tail of the last segment
+                        logging.warning(f"Ignoring partial journal record in {segment}")
+                        break
+                    records.append(record)
+                    self.lsn = max(self.lsn, record["lsn"])
+        return snapshot, records
+
+    def start(self):
+        with self._io_lock:
+            self._open_segment()
+        self._flusher = threading.Thread(target=self._flush_loop, name="journal-flusher", daemon=True)
+        self._flusher.start()
+
+    def append(self, op: str, **args):
+        with self._lock:
+            self.lsn += 1
+            self._buffer.append(json.dumps({"lsn": self.lsn, "op": op, "args": args}, default=str))
+            return self.lsn
+
+    def flush(self):
+        with self._io_lock:
+            self._write(self._take())
+
+    def _take(self):
+        # Batches are taken and written under _io_lock, so they reach the file in lsn order
+        with self._lock:
+            if self._file is None:
+                return []
+            batch, self._buffer = self._buffer, []
+            return batch
+
+    def _write(self, batch):
+        if batch:
+            self.run_blocking(self._write_durably, (self._file, "\n".join(batch) + "\n"))
+
+    @staticmethod
+    def _write_durably(f, data):
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("Journal flush failed", exc_info=e)
+
+    def _segments(self):
+        paths = glob.glob(os.path.join(self.directory, SEGMENT_PATTERN))
+        return sorted(paths, key=lambda p: int(os.path.basename(p).split(".")[1]))
+
+    def _open_segment(self):
+        """Moves on to a new segment and returns the last lsn written to the previous ones.
+
+        Caller holds _io_lock. Records appended after the buffer is taken go to the new segment.
+        """
+        with self._lock:
+            if self._file is not None:
+                batch, self._buffer = self._buffer, []
+            else:
+                batch = []  # Not started yet: what is buffered belongs to the first segment
+            start_lsn = self.lsn - len(self._buffer)
+        self._write(batch)
+        if self._file is not None:
+            self._file.close()
+        self._segment = os.path.join(self.directory, f"journal.{start_lsn + 1}.log")
+        self._file = open(self._segment, "a")
+        return start_lsn
+
+    def snapshot(self, capture):
+        """Writes capture(lsn) as the new snapshot and drops the segments it supersedes.
+
+        capture gets the lsn the new segment starts after and must return a picklable state whose
+        "lsn" is at least that value.
+        """
+        with self._io_lock:
+            start_lsn = self._open_segment()
+            current = self._segment
+        state = capture(start_lsn)
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "wb") as f:
+            self.run_blocking(self._write_durably, (f, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(path + ".tmp", path)
+        for segment in self._segments():
+            if segment != current and int(os.path.basename(segment).split(".")[1]) <= start_lsn:
+                os.remove(segment)
+
+    def start_snapshots(self, capture, interval: float):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.snapshot(capture)
+                except Exception as e:
+                    logging.error("Snapshot failed", exc_info=e)
+
+        self._snapshotter = threading.Thread(target=loop, name="journal-snapshots", daemon=True)
+        self._snapshotter.start()
@@ -0,0 +1,67 @@
+from bisect import bisect_left, insort
+from typing import Dict, List, Tuple
+
+
+class Leaderboard:
+    """Members of a group ranked by mtm, highest first, ties broken by user_id.
+
+    Keys are kept sorted as (-mtm, user_id) so top-N is a slice and a user's rank is a bisect.
+    `version` only moves when the order of users changes, not when mtm values alone do.
+    """
+
+    # Above this fraction of changed users a full re-sort beats individual moves
+    RESORT_RATIO = 0.125
+
+    def __init__(self):
+        self._mtm: Dict[str, float] = {}
+        self._keys: List[Tuple[float, str]] = []
+        self.version = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, user_id: str, mtm: float = 0.0):
+        if user_id in self._mtm:
+            self.update(user_id, mtm)
+            return
+        self._mtm[user_id] = mtm
+        insort(self._keys, (-mtm, user_id))
+        self.version += 1
+
+    def update(self, user_id: str, mtm: float):
+        old = self._mtm[user_id]
+        if old == mtm:
+            return
+        old_index = bisect_left(self._keys, (-old, user_id))
+        del self._keys[old_index]
+        new_index = bisect_left(self._keys, (-mtm, user_id))
+        self._keys.insert(new_index, (-mtm, user_id))
+        self._mtm[user_id] = mtm
+        if new_index != old_index:
+            self.version += 1
+
+    def update_many(self, mtms: Dict[str, float]):
+        changed = {user_id: mtm for user_id, mtm in mtms.items() if self._mtm[user_id] != mtm}
+        if len(changed) <= len(self._keys) * self.RESORT_RATIO:
+            for user_id, mtm in changed.items():
+                self.update(user_id, mtm)
+            return
+        self._mtm.update(changed)
+        keys = sorted((-mtm, user_id) for user_id, mtm in self._mtm.items())
+        if any(new[1] != old[1] for new, old in zip(keys, self._keys)):
+            self.version += 1
+        self._keys = keys
+
+    def top(self, n: int = None) -> List[Tuple[str, float]]:
+        keys = self._keys if n is None else self._keys[:n]
+        return [(user_id, -neg_mtm) for neg_mtm, user_id in keys]
+
+    def rank(self, user_id: str) -> int:
+        """1-based position of user_id, or None if they are not ranked."""
+        mtm = self._mtm.get(user_id)
+        if mtm is None:
+            return None
+        return bisect_left(self._keys, (-mtm, user_id)) + 1
+
+    def mtm(self, user_id: str) -> float:
+        return self._mtm.get(user_id)
@@ -0,0 +1,182 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from socketio import packet
+
+# Seconds; ticks have a 1s budget, so the interesting range is well under that
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_metrics = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines += [f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in values]
+        return lines
+
+
+class Histogram:
+    """Observations counted into fixed buckets, plus their sum, per combination of label values.
+
+    An observation is a bisect and three additions under a lock, so it is cheap enough for hot
+    paths; buckets are only made cumulative when rendered.
+    """
+
+    def __init__(self, name: str, help: str, buckets=TIME_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._series = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts)) for labels, counts in self._series.items()]
+        for labels, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {total}")
+        return lines
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+TICK_SECONDS = Histogram("tradewars_tick_seconds", "Wall time of one scheduled market tick")
+TICK_LAG_SECONDS = Histogram("tradewars_tick_lag_seconds", "How late a tick started after its deadline")
+TICK_OVERRUNS = Counter("tradewars_tick_overruns_total", "Ticks that finished after the next tick was due")
+TICKS_SKIPPED = Counter("tradewars_ticks_skipped_total", "Tick deadlines dropped by the skip overrun policy")
+TICK_PHASE_SECONDS = Histogram("tradewars_tick_phase_seconds", "Time spent per tick in each phase of market_tick",
+                               labelnames=("phase",))
+LOCK_WAIT_SECONDS = Histogram("tradewars_lock_wait_seconds", "Time spent waiting to acquire a lock",
+                              labelnames=("lock",))
+LOCK_HOLD_SECONDS = Histogram("tradewars_lock_hold_seconds", "Time a lock was held, from outermost acquire to release",
+                              labelnames=("lock",))
+EMITS = Counter("tradewars_socketio_emits_total", "Socket.IO events sent, counted once per emit however many "
+                "clients are in the room", ("event",))
+EMIT_BYTES = Counter("tradewars_socketio_emit_bytes_total", "Encoded size of the Socket.IO events sent", ("event",))
+
+
+class PhaseClock:
+    """Splits one tick into phases: lap(phase) charges the time since the previous lap to phase.
+
+    Totals are summed over the tick (a phase may recur once per room) and observed once in observe().
+    """
+    __slots__ = ("totals", "last")
+
+    def __init__(self):
+        self.totals = {}
+        self.last = perf_counter()
+
+    def lap(self, phase: str):
+        now = perf_counter()
+        self.totals[phase] = self.totals.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def observe(self):
+        for phase, seconds in self.totals.items():
+            TICK_PHASE_SECONDS.observe(seconds, phase)
+
+
+class TimedRLock:
+    """A reentrant lock that records how long the outermost acquire waited and how long it was held."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.RLock()
+        self._owner = None
+        self._depth = 0
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = threading.get_ident()
+        # Only the owner can have set _owner to its own ident, so this read needs no lock
+        if self._owner == me:
+            self._lock.acquire()
+            self._depth += 1
+            return True
+        started = perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._acquired_at = perf_counter()
+        self._owner, self._depth = me, 1
+        LOCK_WAIT_SECONDS.observe(self._acquired_at - started, self.name)
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            held = perf_counter() - self._acquired_at
+            self._owner = None
+            self._lock.release()
+            LOCK_HOLD_SECONDS.observe(held, self.name)
+        else:
+            self._lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class MeteredPacket(packet.Packet):
+    """Counts each outgoing event and its encoded size.
+
+    The server encodes a room emit once and sends the same bytes to every participant, so this
+    costs one len() per emit.
+    """
+
+    def encode(self):
+        encoded = super().encode()
+        if self.packet_type in (packet.EVENT, packet.BINARY_EVENT) and self.data:
+            event = self.data[0]
+            EMITS.inc(event)
+            EMIT_BYTES.inc(event, amount=sum(map(len, encoded)) if isinstance(encoded, list) else len(encoded))
+        return encoded
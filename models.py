@@ -1,9 +1,21 @@
 import random
+from collections import OrderedDict
 from typing import List, Dict
 from datetime import datetime
-import pandas as pd
 
-from utils import generate_stock_time_series
+from candles import CandleBuilder
+from leaderboard import Leaderboard
+from metrics import TimedRLock
+from orderbook import OrderBook
+from portfolio import MtmEngine
+from price_paths import price_paths
+from price_store import price_store
+from utils import MU, SIGMA, generate_seeded_series
+
+# Candle builders are kept per (stock, freq) that someone reads; any frequency can be asked for, so
+# they are capped per stock and dropped once nobody has read them for a while
+MAX_CANDLE_FREQS = 16
+CANDLE_IDLE_TICKS = 300
 
 
 class User:
@@ -18,8 +30,10 @@ class User:
 
 
 class Group:
-    def __init__(self, group_id, name, creator_id, stock_list, per_user_coins, duration):
+    def __init__(self, group_id, name, creator_id, stock_list, per_user_coins, duration, defer_prices=False, seed=None,
+                 mu=MU, sigma=SIGMA, scenario=None):
         self.group_id = group_id
+        self.lock = TimedRLock("group")  # Owns all per-group state, see InMemoryDB
         self.name = name
         self.creator_id = creator_id
         self.stocks = {}
@@ -28,13 +42,63 @@ class Group:
         self.per_user_coins = per_user_coins
         self.duration = duration
         self.user_data: Dict[str, UserDataPerSession] = {}
+        self.leaderboard = Leaderboard()
+        self.portfolio = MtmEngine(list(self.stocks))
+        self.orders = OrderBook()  # Resting limit and stop orders
         self.state = "CREATED"
+        self.version = 0  # Bumped by ticks, trades, joins and state changes, see response_cache
         self.started_at = None
         self.ended_at = None
         self.active_duration = 0
-        for stock in self.stocks.values():
-            initial_price = random.uniform(100, 200)
-            stock.prices_per_second = generate_stock_time_series(initial_price, duration)
+        self.seed = random.getrandbits(63) if seed is None else seed  # Price series are a function of the seed
+        self.mu = mu
+        self.sigma = sigma
+        # Groups created from a chosen seed share their series through price_paths with the same scenario
+        self.scenario = seed is not None if scenario is None else scenario
+        self.prices = None  # stocks x ticks; each StockData.prices_per_second is a row view of it
+        self.prices_generated = False
+        self.candles: Dict[tuple, CandleBuilder] = OrderedDict()  # Least recently read first
+        self.candle_reads: Dict[tuple, int] = {}  # Tick each builder was last read at
+        self.series_cache: Dict[tuple, tuple] = {}
+        if not defer_prices:
+            self.generate_prices()
+
+    def generate_prices(self):
+        # Builds every stock's series in one batch; callers run this outside the DB lock.
+        if self.prices_generated:
+            return
+        if self.scenario:
+            self._set_prices(price_paths.get(self.seed, list(self.stocks), self.duration, self.mu, self.sigma))
+        else:
+            prices = generate_seeded_series(self.seed, list(self.stocks), self.duration, self.mu, self.sigma)
+            self._set_prices(price_store.store(prices))
+        self.prices_generated = True
+
+    def _set_prices(self, prices):
+        self.prices = prices
+        for stock, row in zip(self.stocks.values(), prices):
+            stock.prices_per_second = row
+
+    def offload_prices(self):
+        """Hands the series of a finished session to the price store, which may map it from disk."""
+        if self.prices is not None and not self.scenario:
+            self._set_prices(price_store.offload(self.prices))
+
+    def to_summary(self):
+        """Bounded-size view for listings; to_dict also carries every member's trades and positions."""
+        return {
+            "group_id": self.group_id,
+            "name": self.name,
+            "creator_id": self.creator_id,
+            "stocks": list(self.stocks),
+            "per_user_coins": self.per_user_coins,
+            "duration": self.duration,
+            "member_count": len(self.user_data),
+            "state": self.state,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "active_duration": self.active_duration,
+        }
 
     def to_dict(self):
         return {
@@ -51,48 +115,122 @@ class Group:
             "active_duration": self.active_duration,
         }
 
+    def __getstate__(self):
+        # Snapshots leave out the lock, derived candle state and the prices, which the seed regenerates
+        state = self.__dict__.copy()
+        del state["lock"], state["candles"], state["candle_reads"], state["series_cache"], state["prices"]
+        state["stocks"] = list(self.stocks)
+        return state
+
+    def __setstate__(self, state):
+        stock_ids = state.pop("stocks")
+        self.__dict__.update(state)
+        self.lock = TimedRLock("group")
+        self.candles = OrderedDict()
+        self.candle_reads = {}
+        self.series_cache = {}
+        self.stocks = {stock: StockData(stock) for stock in stock_ids}
+        self.prices = None
+        if self.prices_generated:
+            self.prices_generated = False
+            self.generate_prices()
+            if self.state == "FINISHED":
+                self.offload_prices()
+
+    def current_prices(self):
+        return self.prices[:, self.active_duration]
+
+    def current_price(self, stock_id) -> float:
+        # float() so float32 series still serialize to JSON and the journal
+        return float(self.stocks[stock_id].prices_per_second[self.active_duration])
+
+    def candle_builder(self, stock_id, freq):
+        key = (stock_id, freq)
+        builder = self.candles.get(key)
+        if builder is None:
+            # First request for this frequency backfills once, later ticks only update the live bar
+            builder = CandleBuilder(freq, self.started_at)
+            builder.extend(self.started_at, self.stocks[stock_id].prices_per_second[:self.active_duration + 1])
+            if len(self.candles) >= MAX_CANDLE_FREQS * len(self.stocks):
+                oldest = next(iter(self.candles))
+                if self.active_duration - self.candle_reads[oldest] <= 1:
+                    # Every cached builder is in use by the tick loop: serve this one without keeping it
+                    return builder
+                self._drop_candles(oldest)
+            self.candles[key] = builder
+        else:
+            self.candles.move_to_end(key)
+        self.candle_reads[key] = self.active_duration
+        return builder
+
+    def _drop_candles(self, key):
+        del self.candles[key], self.candle_reads[key]
+        self.series_cache.pop(key, None)
+
+    def update_candles(self):
+        while self.candles:
+            key = next(iter(self.candles))
+            if self.active_duration - self.candle_reads[key] <= CANDLE_IDLE_TICKS:
+                break
+            self._drop_candles(key)
+        timestamp = self.started_at + self.active_duration
+        for (stock_id, _), builder in self.candles.items():
+            builder.update(timestamp, self.current_price(stock_id))
+
+    def ohlc_candles_delta(self, stock_id, freq):
+        return self.candle_builder(stock_id, freq).delta()
+
     def to_ohlc_candles(self, stock_id, freq):
-        stock_ = self.stocks[stock_id]
-
-        # Create a pandas Series with the price data and a datetime index
-        price_series = pd.Series(
-            stock_.prices_per_second[:self.active_duration+1],
-            index=pd.to_datetime(self.started_at, unit='s') + pd.to_timedelta(pd.Series(range(self.active_duration + 1)), unit='s')
-        )
-        # Resample the data to the desired frequency and get OHLC values
-        ohlc_df = price_series.resample(freq).ohlc()
-        return ohlc_df
+        # Shared by every caller within the same tick, so the result must be treated as read-only
+        key = (stock_id, freq)
+        cached = self.series_cache.get(key)
+        if cached is not None and cached[0] == self.active_duration:
+            return cached[1]
+        records = self.candle_builder(stock_id, freq).to_records()
+        self.series_cache[key] = (self.active_duration, records)
+        return records
+
 class StockData:
     def __init__(self, id):
         self.id = id
         self.prices_per_second = []
 
 class UserDataPerSession:
-    def __init__(self, coins):
+    __slots__ = ("available_coins", "portfolio", "row", "trades", "open_positions", "roundtrips", "version")
+
+    def __init__(self, coins, portfolio: MtmEngine, user_id):
         self.available_coins = coins
-        self.mtm = 0.0
+        self.portfolio = portfolio
+        self.row = portfolio.add_user(user_id)
         self.trades: List[Trade] = []
-        self.open_positions: List[OpenPosition] = []
+        self.open_positions: Dict[str, OpenPosition] = {}  # At most one open position per stock
         self.roundtrips: List[RoundTrip] = []
+        self.version = 0  # Bumped by every trade of this user
+
+    @property
+    def mtm(self):
+        # Kept up to date by the group's MtmEngine on every tick and trade
+        return float(self.portfolio.mtm[self.row])
 
-    def update_mtm(self):
-        mtm = 0.0
-        for rt in self.roundtrips:
-            mtm += rt.pnl
-        for op in self.open_positions:
-            mtm += op.pnl
-        self.mtm = mtm
+    def refresh_positions(self):
+        """Brings current_price and pnl of open positions in line with the last mark."""
+        for op in self.open_positions.values():
+            op.current_price = float(self.portfolio.prices[self.portfolio.stock_index[op.stock]])
+            op.update_pnl()
 
     def to_dict(self):
+        self.refresh_positions()
         return {
             "available_coins": self.available_coins,
             "mtm": self.mtm,
             "trades": [trade.to_dict() for trade in self.trades],
-            "open_positions": [position.to_dict() for position in self.open_positions],
+            "open_positions": [position.to_dict() for position in self.open_positions.values()],
             "roundtrips": [round_trip.to_dict() for round_trip in self.roundtrips],
         }
 
 class RoundTrip:
+    __slots__ = ("user_id", "stock", "quantity", "entry_price", "entry_time", "exit_price", "exit_time", "direction", "pnl")
+
     def __init__(self, user_id, stock, quantity, entry_price, entry_time, exit_price, exit_time, direction):
         self.user_id = user_id
         self.stock = stock
@@ -121,6 +259,8 @@ class RoundTrip:
         return f"RoundTrip(user_id='{self.user_id}', stock='{self.stock}', quantity={self.quantity}, entry_price={self.entry_price}, entry_time={self.entry_time}, exit_price={self.exit_price}, exit_time={self.exit_time}, direction='{self.direction}')"
 
 class OpenPosition:
+    __slots__ = ("user_id", "stock", "quantity", "entry_price", "entry_time", "direction", "current_price", "pnl")
+
     def __init__(self, user_id, stock, quantity, entry_price, entry_time, direction):
         self.user_id = user_id
         self.stock = stock
@@ -150,13 +290,15 @@ class OpenPosition:
         return f"OpenPosition(user_id='{self.user_id}', stock='{self.stock}', quantity={self.quantity}, entry_price={self.entry_price}, entry_time={self.entry_time}, direction='{self.direction}')"
 
 class Trade:
-    def __init__(self, user_id, stock, quantity, price, direction):
+    __slots__ = ("user_id", "stock", "quantity", "price", "direction", "timestamp")
+
+    def __init__(self, user_id, stock, quantity, price, direction, timestamp=None):
         self.user_id = user_id
         self.stock = stock
         self.quantity = quantity
         self.price = price
         self.direction = direction  # "BUY" or "SELL"
-        self.timestamp = datetime.now()  # Add timestamp to the trade
+        self.timestamp = timestamp or datetime.now()  # Add timestamp to the trade
 
     def to_dict(self):
         return {
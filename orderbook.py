@@ -0,0 +1,137 @@
+import heapq
+from typing import Dict, List
+
+LIMIT = "LIMIT"
+STOP = "STOP"
+
+OPEN = "OPEN"
+FILLED = "FILLED"
+REJECTED = "REJECTED"
+CANCELLED = "CANCELLED"
+EXPIRED = "EXPIRED"
+
+
+class PendingOrder:
+    __slots__ = ("order_id", "user_id", "stock", "quantity", "direction", "order_type", "trigger_price",
+                 "status", "fill_price", "error", "entry")
+
+    def __init__(self, order_id, user_id, stock, quantity, direction, order_type, trigger_price):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.stock = stock
+        self.quantity = quantity
+        self.direction = direction
+        self.order_type = order_type
+        self.trigger_price = trigger_price
+        self.status = OPEN
+        self.fill_price = None
+        self.error = None
+        self.entry = 0  # Heap entry currently representing this order (0 once popped), see OrderBook
+
+    def triggers_below(self) -> bool:
+        """True if the order fires when the price falls to trigger_price (buy limit, sell stop)."""
+        return (self.order_type == LIMIT) == (self.direction == "BUY")
+
+    def to_dict(self):
+        return {
+            "order_id": self.order_id,
+            "user_id": self.user_id,
+            "stock": self.stock,
+            "quantity": self.quantity,
+            "direction": self.direction,
+            "order_type": self.order_type,
+            "trigger_price": self.trigger_price,
+            "status": self.status,
+            "fill_price": self.fill_price,
+            "error": self.error,
+        }
+
+
+class OrderBook:
+    """Resting limit and stop orders of one group, indexed per stock by trigger price.
+
+    Each stock has two heaps: orders that fire when the price falls to their trigger (max-heap) and
+    orders that fire when it rises to it (min-heap). A tick only pops the entries its price crossed,
+    so untouched orders cost nothing. Cancels and modifications leave the old heap entry in place
+    and it is skipped when popped; the heaps are rebuilt from the open orders once such stale
+    entries dominate. Closed orders stay in `orders` and the per-user index for lookups and
+    history, but nothing that runs per tick or per compaction walks them.
+    """
+
+    def __init__(self):
+        self.orders: Dict[str, PendingOrder] = {}  # Every order by id, open or closed
+        self.open: Dict[str, PendingOrder] = {}
+        self._by_user: Dict[str, Dict[str, PendingOrder]] = {}
+        self._below: Dict[str, list] = {}
+        self._above: Dict[str, list] = {}
+        self._seq = 0
+        self._entries = 0
+        self._stale = 0
+
+    def next_order_id(self) -> str:
+        self._seq += 1
+        return f"O{self._seq}"
+
+    def add(self, order: PendingOrder):
+        self.orders[order.order_id] = order
+        self.open[order.order_id] = order
+        self._by_user.setdefault(order.user_id, {})[order.order_id] = order
+        self._seq = max(self._seq, int(order.order_id[1:]))
+        self._push(order)
+
+    def _push(self, order: PendingOrder):
+        self._entries += 1
+        order.entry = self._entries
+        if order.triggers_below():
+            heapq.heappush(self._below.setdefault(order.stock, []), (-order.trigger_price, order.entry, order.order_id))
+        else:
+            heapq.heappush(self._above.setdefault(order.stock, []), (order.trigger_price, order.entry, order.order_id))
+
+    def close(self, order: PendingOrder, status: str):
+        """Takes an open order out of the book with its final status; its heap entry goes stale."""
+        order.status = status
+        del self.open[order.order_id]
+        if order.entry:
+            order.entry = 0
+            self._stale += 1
+            self._maybe_compact()
+
+    def reprice(self, order: PendingOrder, trigger_price: float):
+        order.trigger_price = trigger_price
+        self._stale += 1
+        self._push(order)
+        self._maybe_compact()
+
+    def triggered(self, stock: str, price: float) -> List[PendingOrder]:
+        """Pops every open order on stock whose trigger price crossed, in the order they were queued."""
+        crossed = []
+        below = self._below.get(stock)
+        while below and -below[0][0] >= price:
+            crossed.append(heapq.heappop(below))
+        above = self._above.get(stock)
+        while above and above[0][0] <= price:
+            crossed.append(heapq.heappop(above))
+        fired = []
+        for _, entry, order_id in sorted(crossed, key=lambda item: item[1]):
+            order = self.orders[order_id]
+            if order.status == OPEN and order.entry == entry:
+                order.entry = 0
+                fired.append(order)
+            else:
+                self._stale -= 1
+        return fired
+
+    def open_orders(self) -> List[PendingOrder]:
+        return list(self.open.values())
+
+    def for_user(self, user_id: str) -> List[PendingOrder]:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def _maybe_compact(self):
+        if self._stale <= max(64, len(self.open)):
+            return
+        self._below, self._above = {}, {}
+        for order in self.open.values():
+            if order.entry:
+                self._push(order)
+        self._stale = 0
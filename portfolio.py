@@ -0,0 +1,74 @@
+from typing import Dict, List
+
+import numpy as np
+
+
+class MtmEngine:
+    """Holdings, average entry price and realized P&L of every member of a group.
+
+    State is held in users x stocks arrays, so marking the whole group to market on a tick is a
+    handful of vectorized operations. Realized P&L is accumulated as trades close instead of
+    being re-summed from round trips.
+    """
+
+    def __init__(self, stock_ids: List[str], capacity: int = 8):
+        self.stock_index: Dict[str, int] = {stock_id: i for i, stock_id in enumerate(stock_ids)}
+        self.user_index: Dict[str, int] = {}
+        self.user_ids: List[str] = []
+        self.prices = np.zeros(len(stock_ids))
+        self.holdings = np.zeros((capacity, len(stock_ids)))
+        self.avg_price = np.zeros((capacity, len(stock_ids)))
+        self.realized = np.zeros((capacity, len(stock_ids)))
+        self.unrealized = np.zeros((capacity, len(stock_ids)))
+        self.mtm = np.zeros(capacity)
+
+    def add_user(self, user_id: str) -> int:
+        row = self.user_index.get(user_id)
+        if row is not None:
+            return row
+        row = len(self.user_ids)
+        if row == self.mtm.shape[0]:
+            self._grow(2 * row)
+        self.user_index[user_id] = row
+        self.user_ids.append(user_id)
+        return row
+
+    def _grow(self, capacity: int):
+        for name in ("holdings", "avg_price", "realized", "unrealized", "mtm"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:])
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+
+    def buy(self, user_id: str, stock_id: str, quantity: float, price: float):
+        row, col = self.user_index[user_id], self.stock_index[stock_id]
+        held = self.holdings[row, col]
+        self.avg_price[row, col] = (self.avg_price[row, col] * held + price * quantity) / (held + quantity)
+        self.holdings[row, col] = held + quantity
+        self._mark_row(row)
+
+    def sell(self, user_id: str, stock_id: str, quantity: float, price: float) -> float:
+        """Closes quantity at price against the average entry and returns the realized P&L."""
+        row, col = self.user_index[user_id], self.stock_index[stock_id]
+        pnl = (price - self.avg_price[row, col]) * quantity
+        self.realized[row, col] += pnl
+        self.holdings[row, col] -= quantity
+        if self.holdings[row, col] <= 0:
+            self.holdings[row, col] = 0
+            self.avg_price[row, col] = 0
+        self._mark_row(row)
+        return pnl
+
+    def mark(self, prices):
+        """Re-prices every open position at prices (ordered like stock_index) and refreshes mtm."""
+        self.prices = np.asarray(prices, dtype=np.float64)
+        n = len(self.user_ids)
+        np.multiply(self.holdings[:n], self.prices - self.avg_price[:n], out=self.unrealized[:n])
+        np.add(self.realized[:n].sum(axis=1), self.unrealized[:n].sum(axis=1), out=self.mtm[:n])
+
+    def _mark_row(self, row: int):
+        self.unrealized[row] = self.holdings[row] * (self.prices - self.avg_price[row])
+        self.mtm[row] = self.realized[row].sum() + self.unrealized[row].sum()
+
+    def mtm_by_user(self) -> Dict[str, float]:
+        return dict(zip(self.user_ids, self.mtm[:len(self.user_ids)].tolist()))
@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+
+from price_store import price_store
+from utils import generate_seeded_series
+
+
+class PricePathLibrary:
+    """Generated price series of scenario groups, shared between groups playing the same scenario.
+
+    Entries are keyed by (seed, stock ids, duration, mu, sigma) and stored read-only with the price
+    store's dtype, so every group created from the same scenario reads one buffer. The least recently
+    used entries are dropped beyond `max_entries`; groups already holding one keep it alive.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries: int = 64):
+        with self._lock:
+            self.max_entries = max_entries
+            self._evict()
+
+    def get(self, seed: int, stock_ids, duration: int, mu: float, sigma: float):
+        key = (seed, tuple(stock_ids), duration, mu, sigma)
+        with self._lock:
+            prices = self._entries.get(key)
+            if prices is not None:
+                self._entries.move_to_end(key)
+                return prices
+
+        # Generated outside the lock; if two groups race on a new scenario the first one stored wins
+        prices = generate_seeded_series(seed, stock_ids, duration, mu, sigma).astype(price_store.dtype, copy=False)
+        prices.flags.writeable = False
+        with self._lock:
+            prices = self._entries.setdefault(key, prices)
+            self._entries.move_to_end(key)
+            self._evict()
+        return prices
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+price_paths = PricePathLibrary()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import numpy as np
+
+
+class PriceStore:
+    """Decides how a group's (stocks x ticks) price array is held.
+
+    Series are stored with `dtype` (float64, or float32 for half the memory). With a `directory`,
+    groups of at least `mmap_min_points` points, and every finished group, are written to a file
+    there and mapped back read-only, so the OS can page them out. Each series gets its own
+    anonymous file, which is unlinked once mapped and so goes away with its last mapping.
+    """
+
+    def __init__(self, dtype: str = "float64", directory: str = None, mmap_min_points: int = 1_000_000):
+        self.configure(dtype, directory, mmap_min_points)
+
+    def configure(self, dtype: str = "float64", directory: str = None, mmap_min_points: int = 1_000_000):
+        if dtype not in ("float64", "float32"):
+            raise ValueError(f"Unsupported price dtype: {dtype}")
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self.mmap_min_points = mmap_min_points
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def store(self, prices: np.ndarray) -> np.ndarray:
+        prices = prices.astype(self.dtype, copy=False)
+        if self.directory and prices.size >= self.mmap_min_points:
+            return self._map(prices)
+        return prices
+
+    def offload(self, prices: np.ndarray) -> np.ndarray:
+        """Moves a series that will no longer change to a mapped file, if a directory is configured."""
+        if not self.directory or isinstance(prices, np.memmap):
+            return prices
+        return self._map(prices)
+
+    def _map(self, prices: np.ndarray) -> np.memmap:
+        # Named by mkstemp, never by group id: ids come from clients, and two series never share a file
+        fd, path = tempfile.mkstemp(suffix=".prices", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                prices.tofile(f)
+            mapped = np.memmap(path, dtype=prices.dtype, mode="r", shape=prices.shape)
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # Windows cannot remove a mapped file; it is left in the directory
+        return mapped
+
+
+price_store = PriceStore()
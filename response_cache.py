@@ -0,0 +1,49 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+# Versions restart at zero with the process, so ETags carry a per-boot prefix
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+class ResponseCache:
+    """Serialized JSON responses keyed by resource and the version counter they were built at.
+
+    `version` is a callable returning the resource's current version (group or user counter). A
+    request whose If-None-Match matches gets a 304, an unchanged resource is served from the cached
+    bytes, and only a changed one calls `build`. Entries are evicted least recently used first.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def respond(self, key, version, build):
+        current = version()
+        etag = f"{BOOT_ID}-{current}"
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == current:
+                self._entries.move_to_end(key)
+                return self._response(entry[1], etag)
+
+        body = current_app.json.dumps(build())
+        # Only keep the body if no tick or trade landed while it was being built
+        if version() != current:
+            return Response(body, mimetype="application/json")
+        with self._lock:
+            self._entries[key] = (current, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return self._response(body, etag)
+
+    @staticmethod
+    def _response(body, etag):
+        return Response(body, mimetype="application/json", headers={"ETag": f'"{etag}"'})
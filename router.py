@@ -0,0 +1,302 @@
+import atexit
+import http.client
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+
+import db
+from routes import auth
+from routes.groups import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from sharding import shard_for, new_group_id
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(processName)s  %(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                    datefmt='%d-%b-%y %H:%M:%S')
+
+# Sharded deployment: this process spawns SHARDS copies of app.py, each owning the groups that
+# shard_for assigns it (with their sessions, ticks and sockets), and routes HTTP by group_id.
+# Users live here and are replicated to every shard as they register. Socket.IO clients ask
+# /getShard/<group_id> which worker to connect to.
+app = Flask(__name__)
+app.config['HOST'] = os.environ.get('HOST', '127.0.0.1')
+app.config['PORT'] = int(os.environ.get('PORT', 5000))
+app.config['SHARDS'] = int(os.environ.get('SHARDS', os.cpu_count() or 1))
+app.config['SHARD_BASE_PORT'] = int(os.environ.get('SHARD_BASE_PORT', app.config['PORT'] + 1))
+app.config['JOURNAL_DIR'] = os.environ.get('JOURNAL_DIR')
+app.config['JOURNAL_FLUSH_INTERVAL'] = float(os.environ.get('JOURNAL_FLUSH_INTERVAL', 0.05))
+app.config['SNAPSHOT_INTERVAL'] = float(os.environ.get('SNAPSHOT_INTERVAL', 300))
+app.config['REPLICATION_TIMEOUT'] = float(os.environ.get('REPLICATION_TIMEOUT', 10))
+app.register_blueprint(auth.bp)
+
+# Routes that carry their group in the path, in the body, or that list groups across every shard
+GROUP_PATHS = Map([Rule(path, endpoint=path) for path in (
+    '/begin_session/<group_id>',
+    '/get_tick_stats/<group_id>',
+    '/get_stock_list/<group_id>',
+    '/get_user_positions/<user_id>/<group_id>',
+    '/get_orders/<user_id>/<group_id>',
+    '/get_price_series/<group_id>/<stock_symbol>/<freq>',
+    '/getGroupDetails/<group_id>',
+    '/getLeaderboard/<group_id>',
+    '/getLeaderboardRank/<group_id>/<user_id>',
+    '/getMargin/<group_id>/<user_id>',
+)], strict_slashes=False).bind('')
+BODY_ROUTED = {'/createGroup', '/joinGroup', '/place_order', '/place_orders', '/cancel_order', '/modify_order'}
+LISTINGS = Map([Rule(path, endpoint=path) for path in (
+    '/getGroups/<user_id>',
+    '/getAllGroups',
+    '/getAllJoinableGroupsForUser/<user_id>',
+)], strict_slashes=False).bind('')
+
+FORWARDED_REQUEST_HEADERS = ('Content-Type', 'If-None-Match')
+FORWARDED_RESPONSE_HEADERS = {'content-type', 'etag', 'x-next-cursor'}
+
+_connections = threading.local()
+
+
+def shard_port(shard: int) -> int:
+    return app.config['SHARD_BASE_PORT'] + shard
+
+
+def shard_of(group_id) -> int:
+    return shard_for(str(group_id), app.config['SHARDS']) if group_id else 0
+
+
+def shard_request(shard: int, method: str, path: str, body: bytes = None, headers=None):
+    """Sends one request to a shard over this thread's connection and returns (status, headers, body)."""
+    pool = getattr(_connections, 'pool', None)
+    if pool is None:
+        pool = _connections.pool = {}
+    for attempt in range(2):
+        conn = pool.get(shard)
+        if conn is None:
+            conn = pool[shard] = http.client.HTTPConnection(app.config['HOST'], shard_port(shard), timeout=30)
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            return response.status, response.getheaders(), response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            del pool[shard]
+            # A kept-alive connection the shard already dropped is only retried when that is safe
+            if attempt or method != 'GET':
+                raise
+
+
+def forward(shard: int, body: bytes = None):
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    path = request.full_path if request.query_string else request.path
+    try:
+        status, response_headers, data = shard_request(shard, request.method, path,
+                                                       request.get_data() if body is None else body, headers)
+    except (http.client.HTTPException, OSError) as e:
+        logging.error(f"Shard {shard} request failed", exc_info=e)
+        return jsonify({"error": "Shard unavailable"}), 502
+    return Response(data, status=status,
+                    headers=[(k, v) for k, v in response_headers if k.lower() in FORWARDED_RESPONSE_HEADERS])
+
+
+def list_across_shards():
+    """Pages through a group listing shard by shard; the cursor is "<shard>:<that shard's cursor>"."""
+    try:
+        shard, after = map(int, request.args.get('cursor', '0:-1').split(':'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    if shard < 0 or after < -1:
+        return jsonify({"error": "Invalid cursor"}), 400
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+
+    page, next_cursor = [], None
+    while shard < app.config['SHARDS'] and len(page) < limit:
+        args = {**request.args.to_dict(), 'limit': limit - len(page), 'cursor': after}
+        try:
+            status, response_headers, data = shard_request(shard, 'GET', f"{request.path}?{urlencode(args)}", None, headers)
+        except (http.client.HTTPException, OSError) as e:
+            logging.error(f"Shard {shard} request failed", exc_info=e)
+            return jsonify({"error": "Shard unavailable"}), 502
+        if status != 200:
+            return Response(data, status=status, mimetype='application/json')
+        page += json.loads(data)
+        shard_cursor = dict((k.lower(), v) for k, v in response_headers).get('x-next-cursor')
+        if shard_cursor is not None:
+            next_cursor = f"{shard}:{shard_cursor}"
+            break
+        shard, after = shard + 1, -1
+    else:
+        if shard < app.config['SHARDS']:
+            next_cursor = f"{shard}:-1"
+
+    response = jsonify(page)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+
+@app.after_request
+def replicated_before_reply(response):
+    # A user gets their id only once every shard knows them, so their next request can use it
+    if request.path in ('/register', '/registerBulk') and response.status_code < 300:
+        replicator = db.db_instance.journal
+        if isinstance(replicator, ShardReplicator) and not replicator.wait(app.config['REPLICATION_TIMEOUT']):
+            logging.warning(f"{request.path} answered before every shard had the new users")
+    return response
+
+
+@app.route('/getShard/<group_id>', methods=['GET'])
+def get_shard(group_id):
+    shard = shard_of(group_id)
+    host = request.host.rsplit(':', 1)[0]
+    return jsonify({"shard": shard, "url": f"{request.scheme}://{host}:{shard_port(shard)}"}), 200
+
+
+@app.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'PUT', 'DELETE'])
+@app.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+def route(path):
+    path = '/' + path
+    if path in BODY_ROUTED:
+        data = request.get_json(silent=True) or {}
+        if path == '/createGroup' and not data.get('group_id'):
+            data = {**data, 'group_id': new_group_id()}
+        return forward(shard_of(data.get('group_id')), json.dumps(data).encode())
+    try:
+        _, args = GROUP_PATHS.match(path)
+        return forward(shard_of(args['group_id']))
+    except NotFound:
+        pass
+    try:
+        LISTINGS.match(path)
+        return list_across_shards()
+    except NotFound:
+        pass
+    # Swagger and anything else not tied to a group is the same on every shard
+    return forward(0)
+
+
+class ShardReplicator:
+    """Takes the journal's place on the router's InMemoryDB and copies new users to every shard.
+
+    Records still go to the wrapped journal first when there is one. append() runs under the
+    registry lock, so it only queues the users; one thread per shard sends them to /registerBulk,
+    in order, and retries a batch until that shard has accepted it. wait() then blocks the
+    registering request, outside the lock, until every shard has its users.
+    """
+
+    def __init__(self, shards: int, journal=None, retry_interval: float = 1.0):
+        self.shards = shards
+        self.journal = journal
+        self.retry_interval = retry_interval
+        self._queues = [queue.Queue() for _ in range(shards)]
+        self._queued = 0  # batches queued so far, the same count on every shard's queue
+        self._acked = [0] * shards  # batches each shard has accepted
+        self._acked_changed = threading.Condition()
+        self._mine = threading.local()
+        for shard in range(shards):
+            threading.Thread(target=self._replicate, args=(shard,), name=f"replicate-{shard}", daemon=True).start()
+
+    def __getattr__(self, name):
+        return getattr(self.journal, name)
+
+    def append(self, op: str, **args):
+        lsn = self.journal.append(op, **args) if self.journal is not None else None
+        if op == "add_user":
+            records = [{"id": args["user_id"], "phone": args["phone"], "name": args["name"], "password": args["password"]}]
+        elif op == "add_users":
+            records = args["records"]
+        else:
+            return lsn
+        # Called under the registry lock, so batches are numbered in queue order
+        self._queued += 1
+        for pending in self._queues:
+            pending.put((self._queued, records))
+        self._mine.batch = self._queued
+        return lsn
+
+    def wait(self, timeout: float) -> bool:
+        """Blocks until every shard has accepted the users this thread queued; False on timeout."""
+        batch = getattr(self._mine, 'batch', 0)
+        self._mine.batch = 0
+        with self._acked_changed:
+            return self._acked_changed.wait_for(lambda: min(self._acked) >= batch, timeout)
+
+    def _replicate(self, shard: int):
+        pending = self._queues[shard]
+        while True:
+            batch, records = pending.get()
+            # Whatever queued up meanwhile goes in the same request
+            while not pending.empty():
+                batch, more = pending.get_nowait()
+                records = records + more
+            body = json.dumps({"users": records}).encode()
+            while True:
+                try:
+                    status, _, data = shard_request(shard, 'POST', '/registerBulk', body, {'Content-Type': 'application/json'})
+                except (http.client.HTTPException, OSError) as e:
+                    status, data = None, repr(e)
+                if status == 200:
+                    break
+                logging.warning(f"Replicating users to shard {shard} failed, retrying: {status} {data!r}")
+                time.sleep(self.retry_interval)
+            with self._acked_changed:
+                self._acked[shard] = batch
+                self._acked_changed.notify_all()
+
+
+def start_shards():
+    processes = []
+    for shard in range(app.config['SHARDS']):
+        env = {**os.environ, 'SHARD_INDEX': str(shard), 'SHARD_COUNT': str(app.config['SHARDS']),
+               'HOST': app.config['HOST'], 'PORT': str(shard_port(shard))}
+        if app.config['JOURNAL_DIR']:
+            env['JOURNAL_DIR'] = os.path.join(app.config['JOURNAL_DIR'], f"shard-{shard}")
+        processes.append(subprocess.Popen([sys.executable, 'app.py'], env=env,
+                                          cwd=os.path.dirname(os.path.abspath(__file__))))
+
+    def stop():
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    atexit.register(stop)
+    # atexit only runs on a normal exit, so turn SIGTERM into one
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    deadline = time.time() + 60
+    for shard, process in enumerate(processes):
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Shard {shard} exited with {process.returncode}")
+            try:
+                socket.create_connection((app.config['HOST'], shard_port(shard)), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError(f"Shard {shard} did not start listening")
+                time.sleep(0.2)
+    return processes
+
+
+if __name__ == '__main__':
+    start_shards()
+    # The shards load the same seed users themselves, so only later registrations are replicated
+    with open("./config/initData.json", "r") as f:
+        seed = {"users": json.load(f)["users"], "groups": []}
+    if app.config['JOURNAL_DIR']:
+        db.init_durable(os.path.join(app.config['JOURNAL_DIR'], "router"), seed,
+                        app.config['JOURNAL_FLUSH_INTERVAL'], app.config['SNAPSHOT_INTERVAL'])
+    else:
+        db.init(seed)
+    db.db_instance.journal = ShardReplicator(app.config['SHARDS'], db.db_instance.journal)
+    app.run(host=app.config['HOST'], port=app.config['PORT'], threaded=True)
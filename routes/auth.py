@@ -32,15 +32,59 @@ def register():
     if not all([phone, name, password]):
         return jsonify({"error": "Missing fields"}), 400
 
-    with db_instance.lock:
-        if any(user.phone == phone for user in users.values()):
-            return jsonify({"error": "User with this phone number already exists"}), 400
-
-        user_id = f"UI{int(uuid.uuid4().hex[:12], 16) % 10**10}"
+    user_id = new_user_id()
+    try:
         db_instance.add_user(user_id, phone, name, password)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     return jsonify({"user_id": user_id}), 201
 
+def new_user_id():
+    return f"UI{int(uuid.uuid4().hex[:12], 16) % 10**10}"
+
+@bp.route('/registerBulk', methods=['POST'])
+@swag_from({
+    'parameters': [
+        {'name': 'body', 'in': 'body', 'required': True, 'schema': {
+            'type': 'object',
+            'properties': {
+                'users': {'type': 'array', 'items': {
+                    'type': 'object',
+                    'properties': {
+                        'id': {'type': 'string', 'description': 'Optional, generated when missing'},
+                        'phone': {'type': 'string'},
+                        'name': {'type': 'string'},
+                        'password': {'type': 'string'}
+                    }
+                }}
+            }
+        }}
+    ],
+    'responses': {
+        200: {'description': 'Per-user result, in request order'},
+        400: {'description': 'Missing users list'}
+    }
+})
+def register_bulk():
+    data = request.get_json()
+    records = data.get('users')
+    if not isinstance(records, list):
+        return jsonify({"error": "Missing users list"}), 400
+
+    results = [None] * len(records)
+    valid, positions = [], []
+    for i, record in enumerate(records):
+        if not isinstance(record, dict) or not all([record.get('phone'), record.get('name'), record.get('password')]):
+            results[i] = {"error": "Missing fields"}
+            continue
+        valid.append({**record, "id": record.get('id') or new_user_id()})
+        positions.append(i)
+
+    for i, record, error in zip(positions, valid, db_instance.add_users(valid)):
+        results[i] = {"error": error} if error else {"user_id": record["id"]}
+    return jsonify(results), 200
+
 @bp.route('/login', methods=['POST'])
 @swag_from({
     'parameters': [
@@ -62,10 +106,10 @@ def login():
     phone = data.get('phone')
     password = data.get('password')
 
-    with db_instance.lock:
-        for user_id, user in users.items():
-            if user.phone == phone and user.password == password:
-                return jsonify({"user_id": user_id}), 200
+    user_id = db_instance.get_user_id_by_phone(phone)
+    user = users.get(user_id) if user_id else None
+    if user and user.password == password:
+        return jsonify({"user_id": user_id}), 200
 
     return jsonify({"error": "Invalid credentials"}), 401
 
@@ -102,13 +146,13 @@ def get_user_details(user_id):
     }
 })
 def get_user_by_phone(phone):
-    with db_instance.lock:
-        for user_id, user in users.items():
-            if user.phone == phone:
-                return jsonify({
-                    "user_id": user_id,
-                    "phone": user.phone,
-                    "name": user.name
-                }), 200
+    user_id = db_instance.get_user_id_by_phone(phone)
+    user = users.get(user_id) if user_id else None
+    if user:
+        return jsonify({
+            "user_id": user_id,
+            "phone": user.phone,
+            "name": user.name
+        }), 200
 
     return jsonify({"error": "User not found"}), 404
\ No newline at end of file
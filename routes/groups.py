@@ -1,32 +1,66 @@
-import threading
-
 from flask import Blueprint, request, jsonify
-import uuid
 from db import users, groups, db_instance
-from models import UserDataPerSession
+from extension import response_cache
+from sharding import new_group_id, valid_group_id
+from utils import MU, SIGMA
 from flasgger import swag_from
 
-from routes import trading
 
 bp = Blueprint('groups', __name__, url_prefix='/')
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+LIST_PARAMETERS = [
+    {'name': 'detail', 'in': 'query', 'type': 'string', 'enum': ['summary', 'full'], 'required': False,
+     'description': 'summary (default) or full, which includes every member\'s trades and positions'},
+    {'name': 'limit', 'in': 'query', 'type': 'integer', 'required': False,
+     'description': f'Page size, default {DEFAULT_PAGE_SIZE}, at most {MAX_PAGE_SIZE}'},
+    {'name': 'cursor', 'in': 'query', 'type': 'string', 'required': False,
+     'description': 'X-Next-Cursor header of the previous page'},
+]
+
+def group_list_response(fetch):
+    """Pages through fetch(after, limit); the cursor of the next page goes in the X-Next-Cursor header."""
+    detail = request.args.get('detail', 'summary')
+    if detail not in ('summary', 'full'):
+        return jsonify({"error": "detail must be either summary or full"}), 400
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        after = int(request.args.get('cursor', -1))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    # -1 is the start; anything lower would index the group list from its end
+    if after < -1:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    page, next_cursor = fetch(after, limit)
+    response = jsonify([db_instance.get_group_view(group, detail) for group in page])
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response, 200
+
 @bp.route('/createGroup', methods=['POST'])
 @swag_from({
     'parameters': [
         {'name': 'body', 'in': 'body', 'required': True, 'schema': {
             'type': 'object',
             'properties': {
+                'group_id': {'type': 'string', 'description': 'Optional, generated when missing; 1-64 letters, digits, _ or -'},
                 'name': {'type': 'string'},
                 'creator_id': {'type': 'string'},
                 'stock_list': {'type': 'array', 'items': {'type': 'string'}},
                 'per_user_coins': {'type': 'integer'},
-                'duration': {'type': 'integer'}
+                'duration': {'type': 'integer'},
+                'defer_prices': {'type': 'boolean', 'description': 'Generate price series at session start instead of now'},
+                'seed': {'type': 'integer', 'description': 'Scenario seed; groups with the same seed, stocks, duration and model share identical prices'},
+                'mu': {'type': 'number', 'description': f'Drift per second, default {MU}'},
+                'sigma': {'type': 'number', 'description': f'Volatility per second, default {SIGMA}'}
             }
         }}
     ],
     'responses': {
         201: {'description': 'Group created successfully'},
-        400: {'description': 'Missing fields'},
+        400: {'description': 'Missing fields, invalid group_id or scenario, or group already exists'},
         404: {'description': 'User not found'}
     }
 })
@@ -37,17 +71,33 @@ def create_group():
     stock_list = data.get("stock_list")
     per_user_coins = data.get("per_user_coins")
     duration = data.get("duration")
+    defer_prices = bool(data.get("defer_prices", False))
+    seed = data.get("seed")
+    mu = data.get("mu", MU)
+    sigma = data.get("sigma", SIGMA)
 
     if not all([creator_id, stock_list, per_user_coins, duration]):
         return jsonify({"error": "Missing fields"}), 400
+    if not isinstance(stock_list, list) or not all(isinstance(stock, str) and stock for stock in stock_list):
+        return jsonify({"error": "stock_list must be a non-empty list of stock names"}), 400
+    if not all(isinstance(value, int) and not isinstance(value, bool) and value > 0 for value in (per_user_coins, duration)):
+        return jsonify({"error": "per_user_coins and duration must be positive integers"}), 400
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        return jsonify({"error": "seed must be a non-negative integer"}), 400
+    if not isinstance(mu, (int, float)) or not isinstance(sigma, (int, float)) or sigma < 0:
+        return jsonify({"error": "mu must be a number and sigma a non-negative number"}), 400
 
     if creator_id not in users:
         return jsonify({"error": "User not found"}), 404
 
-    group_id = f"GI{int(uuid.uuid4().hex[:12], 16) % 10**10}"
-    db_instance.add_group(group_id, name, creator_id, stock_list, per_user_coins, duration)
-    groups.get(group_id).user_data[creator_id] = UserDataPerSession(per_user_coins)
-    trading.lock[group_id] = threading.RLock()
+    # The sharding router picks the id up front, since it decides which shard owns the group
+    group_id = data.get("group_id") or new_group_id()
+    if not valid_group_id(group_id):
+        return jsonify({"error": "group_id must be 1-64 letters, digits, _ or -"}), 400
+    try:
+        db_instance.add_group(group_id, name, creator_id, stock_list, per_user_coins, duration, defer_prices, seed, mu, sigma)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return jsonify({"group_id": group_id}), 201
 
 @bp.route('/joinGroup', methods=['POST'])
@@ -81,17 +131,15 @@ def join_group():
     if group_id not in groups:
         return jsonify({"error": "Group not found"}), 404
 
-    if group_id in groups.get(group_id).user_data.keys():
+    if not db_instance.join_group(group_id, user_id):
         return jsonify({"error": "User already joined"}), 200
-
-    db_instance.join_group(group_id, user_id)
     return jsonify({"message": "Joined group successfully"}), 200
 
 @bp.route('/getGroups/<user_id>', methods=['GET'])
 @swag_from({
     'parameters': [
         {'name': 'user_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'User ID'}
-    ],
+    ] + LIST_PARAMETERS,
     'responses': {
         200: {'description': 'List of groups the user belongs to'},
         404: {'description': 'User not found'}
@@ -101,11 +149,7 @@ def get_groups(user_id):
     if user_id not in users:
         return jsonify({"error": "User not found"}), 404
 
-    user_groups = []
-    for group_id, group_data in groups.items():
-        if user_id in group_data.user_data:
-            user_groups.append(group_data.to_dict())
-    return jsonify(user_groups), 200
+    return group_list_response(lambda after, limit: db_instance.get_user_groups(user_id, after, limit))
 
 @bp.route('/getGroupDetails/<group_id>', methods=['GET'])
 @swag_from({
@@ -114,69 +158,82 @@ def get_groups(user_id):
     ],
     'responses': {
         200: {'description': 'Group details'},
+        304: {'description': 'Not modified since the ETag in If-None-Match'},
         404: {'description': 'Group not found'}
     }
 })
 def get_group_details(group_id):
     if group_id not in groups:
         return jsonify({"error": "Group not found"}), 404
-    return jsonify(groups[group_id].to_dict()), 200
+    return response_cache.respond(("group", group_id), lambda: db_instance.get_group_version(group_id),
+                                  lambda: db_instance.get_group_details(group_id))
 
 @bp.route('/getLeaderboard/<group_id>', methods=['GET'])
 @swag_from({
     'parameters': [
-        {'name': 'group_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'Group ID'}
+        {'name': 'group_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'Group ID'},
+        {'name': 'top', 'in': 'query', 'type': 'integer', 'required': False, 'description': 'Only return the top N users'}
     ],
     'responses': {
         200: {'description': 'Leaderboard data'},
+        304: {'description': 'Not modified since the ETag in If-None-Match'},
+        400: {'description': 'top is not a positive integer'},
         404: {'description': 'Group not found'}
     }
 })
 def get_leaderboard(group_id):
     if group_id not in groups:
         return jsonify({"error": "Group not found"}), 404
+    top_n = request.args.get('top')
+    if top_n is not None:
+        if not top_n.isdigit() or int(top_n) <= 0:
+            return jsonify({"error": "top must be a positive integer"}), 400
+        top_n = int(top_n)
+    return response_cache.respond(("leaderboard", group_id, top_n), lambda: db_instance.get_group_version(group_id),
+                                  lambda: db_instance.get_leaderboard(group_id, top_n))
 
-    leaderboard = []
-    for user_id, user_data in groups[group_id].user_data.items():
-        leaderboard.append({"user_id": user_id, "user_name": users[user_id].name , "mtm": user_data.mtm})
-
-    sorted_leaderboard = sorted(leaderboard, key=lambda item: item["mtm"], reverse=True)
-
-    return jsonify(sorted_leaderboard), 200
-
-@bp.route('/getAllGroups', methods=['GET'])
+@bp.route('/getLeaderboardRank/<group_id>/<user_id>', methods=['GET'])
 @swag_from({
     'parameters': [
+        {'name': 'group_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'Group ID'},
+        {'name': 'user_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'User ID'}
     ],
+    'responses': {
+        200: {'description': 'Rank and mtm of the user'},
+        404: {'description': 'Group not found or user not in group'}
+    }
+})
+def get_leaderboard_rank(group_id, user_id):
+    if group_id not in groups:
+        return jsonify({"error": "Group not found"}), 404
+    rank = db_instance.get_leaderboard_rank(group_id, user_id)
+    if rank is None:
+        return jsonify({"error": "User not in group"}), 404
+    return jsonify(rank), 200
+
+@bp.route('/getAllGroups', methods=['GET'])
+@swag_from({
+    'parameters': LIST_PARAMETERS,
     'responses': {
         200: {'description': 'List of groups'},
         404: {'description': 'User not found'}
     }
 })
 def get_all_groups():
-   data = []
-   for group_id, group_data in groups.items():
-        data.append(group_data.to_dict())
-   return jsonify(data), 200
+   return group_list_response(db_instance.get_all_groups)
 
 @bp.route('/getAllJoinableGroupsForUser/<user_id>', methods=['GET'])
 @swag_from({
     'parameters': [
         {'name': 'user_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'User ID'}
-    ],
+    ] + LIST_PARAMETERS,
     'responses': {
         200: {'description': 'List of joinable groups for given user'},
         404: {'description': 'User not found'}
     }
 })
 def get_all_joinable_groups_for_user(user_id):
-   data = []
-   for group_id, group_data in groups.items():
-       if user_id not in group_data.user_data.keys():
-           if group_data.state == 'FINISHED':
-               continue
-           data.append(group_data.to_dict())
-   return jsonify(data), 200
+   return group_list_response(lambda after, limit: db_instance.get_joinable_groups(user_id, after, limit))
 
 
 @bp.route('/getMargin/<group_id>/<user_id>', methods=['GET'])
@@ -187,12 +244,14 @@ def get_all_joinable_groups_for_user(user_id):
     ],
     'responses': {
         200: {'description': 'Available Margin'},
+        304: {'description': 'Not modified since the ETag in If-None-Match'},
         404: {'description': 'User not found'}
     }
 })
 def get_margin(group_id, user_id):
     if group_id not in groups:
         return jsonify({"error": "Group not found"}), 404
-    if user_id not in users:
+    if user_id not in users or not db_instance.check_user(group_id, user_id):
         return jsonify({"error": "User not found"}), 404
-    return jsonify(db_instance.get_margin(group_id, user_id)), 200
\ No newline at end of file
+    return response_cache.respond(("margin", group_id, user_id), lambda: db_instance.get_user_version(group_id, user_id),
+                                  lambda: db_instance.get_margin(group_id, user_id))
\ No newline at end of file
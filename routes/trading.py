@@ -1,17 +1,20 @@
 import logging
-import threading
 
 from flasgger import Swagger, swag_from
-from flask import Blueprint, request, jsonify, Flask
-from extension import socketio  # Import from extensions
-from db import db_instance
+from flask import Blueprint, request, jsonify, Flask, Response
+from extension import socketio, scheduler, response_cache  # Import from extensions
+import metrics
+from db import db_instance, OrderRejected
+from metrics import PhaseClock
+from subscriptions import SubscriptionRegistry, MARKET, DETAILS, LEADERBOARD, room_name, details_room
 
 
 bp = Blueprint('trading', __name__, url_prefix='')
 db = db_instance
-lock = {}
-rooms = {}
-details_rooms = {}
+subscriptions = SubscriptionRegistry()
+leaderboard_versions = {}
+# Under an async worker a tick only gives up the loop on I/O, so long fan-outs yield every so often
+EMIT_BATCH = 256
 
 @bp.route('/begin_session/<group_id>', methods=['POST'])
 @swag_from({
@@ -40,50 +43,150 @@ def begin_session(group_id):
     if group_state == "FINISHED":
         return jsonify({"error": "Session already finished for this group"}), 400
 
-    thread = threading.Thread(target=market_feed_loop, args=(group_id, db.get_group_duration(group_id)))
-    db.being_session(group_id)
-    lock[group_id] = threading.RLock()
-    thread.start()
+    if not db.being_session(group_id):
+        return jsonify({"error": "Session already running for this group"}), 400
+    scheduler.schedule(group_id, db.get_group_duration(group_id), market_tick, end_session)
     return jsonify({"message": "Session started"}), 200
 
-def market_feed_loop(group_id, duration):
+@bp.route('/get_tick_stats/<group_id>', methods=['GET'])
+@swag_from({
+    'parameters': [
+        {'name': 'group_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'ID of the trading group'}
+    ],
+    'responses': {
+        200: {'description': 'Tick lag, overruns and skipped ticks of the running session'},
+        404: {'description': 'No running session for this group'}
+    }
+})
+def get_tick_stats(group_id):
+    stats = scheduler.stats(group_id)
+    if stats is None:
+        return jsonify({"error": "No running session for this group"}), 404
+    return jsonify(stats), 200
+
+@bp.route('/metrics', methods=['GET'])
+@swag_from({
+    'responses': {
+        200: {'description': 'Tick phase timings, tick lag and overruns, lock wait/hold times and Socket.IO emit '
+                             'counts and bytes of this process, in the Prometheus text format'}
+    }
+})
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def resume_sessions():
+    # Sessions recovered from the journal pick up at the tick they had reached
+    for group_id, remaining in db.get_started_sessions().items():
+        if remaining > 0:
+            scheduler.schedule(group_id, remaining, market_tick, end_session)
+        else:
+            end_session(group_id)
+
+def end_session(group_id):
+    emit_updates(order_updates(group_id, db.end_session(group_id)))
+    subscriptions.drop_group(group_id)
+    leaderboard_versions.pop(group_id, None)
+
+def leaderboard_view(group_id, user_id, top_n):
+    return {"top": db.get_leaderboard(group_id, top_n), "me": db.get_leaderboard_rank(group_id, user_id)}
+
+def leaderboard_updates(group_id, clock):
+    """(event, payload, room) for the shared leaderboard room and every per-user leaderboard subscription."""
+    updates = []
+    room = group_id+"leaderboard"
+    if next(iter(socketio.server.manager.get_participants('/', room)), None) is not None:
+        updates.append(('leaderboard_details', db.get_leaderboard(group_id), room))
+    tops = {}
+    for sub in subscriptions.subscribers(group_id, LEADERBOARD):
+        top_n = sub["top_n"]
+        if top_n not in tops:
+            tops[top_n] = db.get_leaderboard(group_id, top_n)
+        view = {"top": tops[top_n], "me": db.get_leaderboard_rank(group_id, sub["user_id"])}
+        updates.append(('leaderboard_details', view, sub["room_id"]))
+    clock.lap("leaderboard")
+    return updates
+
+def order_updates(group_id, orders):
+    # Resting-order outcomes go to the owner's market room, the one join_group subscribes
+    return [('order_update', order, room_name(group_id, order["user_id"], MARKET)) for order in orders]
+
+def emit_updates(updates, clock=None):
+    for i, (event, payload, room) in enumerate(updates, 1):
+        if i % EMIT_BATCH == 0:
+            socketio.sleep(0)
+        socketio.emit(event, payload, room=room)
+    if clock is not None:
+        clock.lap("emit")
+
+def market_tick(group_id):
+    # Runs once per second per session on the shared scheduler. Every payload is built under the group
+    # lock and only emitted once it is released, so orders, joins and polls never wait on the fan-out.
+    # A tick of a group never overlaps the next one, so its events still go out in tick order; a delta
+    # subscriber that joins in between already has this tick in its snapshot and drops it by seq.
+    # Each phase's time is summed over the tick and exported on /metrics; "simulate" includes "update_pnl"
+    clock = PhaseClock()
     try:
-        for _ in range(duration):
-            with lock[group_id]:
-                try:
-                    market_data = db.simulate(group_id)
-                    logging.info(f"Market Data: {market_data}", )
-                    for _, details in rooms.items():
-                        market_updates = {}
-                        if not db_instance.check_user(group_id, details["user_id"]):
-                            continue
-                        pnl = db.get_pnl(group_id, details["user_id"])
-                        for stock, v in market_data.items():
-                            market_updates[stock] = {
-                                "ltp": v,
-                                "pnl": pnl[stock]
-                            }
-                        socketio.emit('market_update', market_updates, room=details["room_id"])
-                    market_update_details = {}
-                    for _, room_details in details_rooms.items():
-                        if not db_instance.check_user(group_id, room_details["user_id"]):
-                            continue
-                        pnl = db.get_pnl(group_id, room_details["user_id"])
-                        for stock, v in market_data.items():
-                            market_update_details[stock] = {
-                                "ltp": v,
-                                "candles": db.get_stock_price_series(group_id, stock, room_details["freq"]),
-                                "pnl": pnl[stock]
-                            }
-                        socketio.emit('market_update_details', market_update_details, room=room_details["room_id"])
-                    leaderboard_details = db.get_leaderboard(group_id)
-                    socketio.emit('leaderboard_details', leaderboard_details, room=group_id+"leaderboard")
-                except Exception as e:
-                    logging.error(f"GroupId, {group_id}")
-                    logging.error(f"Exception while market update: {group_id}", exc_info=e)
-            socketio.sleep(1)  # Use socketio.sleep to avoid blocking
-    finally:
-        db.end_session(group_id)
+        with db.group_lock(group_id):
+            clock.lap("lock")
+            updates = tick_updates(group_id, clock)
+        emit_updates(updates, clock)
+    except Exception as e:
+        logging.error(f"GroupId, {group_id}")
+        logging.error(f"Exception while market update: {group_id}", exc_info=e)
+    clock.observe()
+
+def tick_updates(group_id, clock):
+    """Advances the group one tick and returns every (event, payload, room) it produces. Caller holds the group lock."""
+    market_data = db.simulate(group_id)
+    clock.lap("simulate")
+    logging.info(f"Market Data: {market_data}", )
+    updates = order_updates(group_id, db.trigger_orders(group_id))
+    clock.lap("trigger_orders")
+    for details in subscriptions.subscribers(group_id, MARKET):
+        market_updates = {}
+        pnl = db.get_pnl(group_id, details["user_id"])
+        clock.lap("get_pnl")
+        for stock, v in market_data.items():
+            market_updates[stock] = {
+                "ltp": v,
+                "pnl": pnl[stock]
+            }
+        updates.append(('market_update', market_updates, details["room_id"]))
+        clock.lap("payload")
+    # Candles only depend on (freq, mode): each set is built, encoded and emitted once to the room
+    # shared by its viewers, and each viewer only gets its own pnl on top
+    seq = db.get_group_tick(group_id)
+    detail_subs = subscriptions.subscribers(group_id, DETAILS)
+    for freq, mode in dict.fromkeys((sub["freq"], sub["mode"]) for sub in detail_subs):
+        market_update_details = {
+            stock: {"ltp": v, "candles": candle_payload(group_id, stock, freq, mode)}
+            for stock, v in market_data.items()
+        }
+        if mode == "delta":
+            market_update_details = {"seq": seq, "stocks": market_update_details}
+        updates.append(('market_update_details', market_update_details, details_room(group_id, freq, mode)))
+        clock.lap("candles")
+    pnl_updates = {}
+    for sub in detail_subs:
+        # A user with several detail subscriptions gets the same pnl on each
+        pnl_update = pnl_updates.get(sub["user_id"])
+        if pnl_update is None:
+            pnl = db.get_pnl(group_id, sub["user_id"])
+            clock.lap("get_pnl")
+            pnl_update = pnl_updates[sub["user_id"]] = {"seq": seq, "pnl": {stock: pnl[stock] for stock in market_data}}
+        updates.append(('market_update_details_pnl', pnl_update, sub["room_id"]))
+        clock.lap("payload")
+    # Only push the leaderboard when the order of users actually changed
+    version = db.get_leaderboard_version(group_id)
+    if leaderboard_versions.get(group_id) != version:
+        leaderboard_versions[group_id] = version
+        updates += leaderboard_updates(group_id, clock)
+    return updates
+
+def candle_payload(group_id, stock, freq, mode):
+    if mode == "delta":
+        return db.get_stock_price_delta(group_id, stock, freq)
+    return db.get_stock_price_series(group_id, stock, freq)
 
 @bp.route('/get_stock_list/<group_id>', methods=['GET'])
 @swag_from({
@@ -98,14 +201,15 @@ def market_feed_loop(group_id, duration):
     ],
     'responses': {
         200: {'description': 'List of stocks'},
+        304: {'description': 'Not modified since the ETag in If-None-Match'},
         404: {'description': 'Group not found'}
     }
 })
 def get_stock_list(group_id):
-    stocks = db.get_stocks(group_id)
-    if not stocks:
+    if db.get_group_state(group_id) is None:
         return jsonify({"error": "Group not found"}), 404
-    return jsonify(stocks), 200
+    # The stock list never changes once a group exists
+    return response_cache.respond(("stocks", group_id), lambda: 0, lambda: db.get_stocks(group_id))
 
 @bp.route('/get_user_positions/<user_id>/<group_id>', methods=['GET'])
 @swag_from({
@@ -122,7 +226,7 @@ def get_user_positions_route(user_id, group_id):
     positions = db.get_user_positions(group_id, user_id)
     if not positions:
         return jsonify({"error": "User or group not found"}), 404
-    return jsonify(positions), 200
+    return jsonify({k: [p.to_dict() for p in v] for k, v in positions.items()}), 200
 
 @bp.route('/place_order', methods=['POST'])
 @swag_from({
@@ -134,54 +238,159 @@ def get_user_positions_route(user_id, group_id):
                 'group_id': {'type': 'string'},
                 'stock': {'type': 'string'},
                 'quantity': {'type': 'integer'},
-                'direction': {'type': 'string', 'enum': ['BUY', 'SELL']}
+                'direction': {'type': 'string', 'enum': ['BUY', 'SELL']},
+                'order_type': {'type': 'string', 'enum': ['MARKET', 'LIMIT', 'STOP'], 'default': 'MARKET'},
+                'trigger_price': {'type': 'number', 'description': 'Limit or stop price, required for LIMIT and STOP'}
             }
         }}
     ],
     'responses': {
-        200: {'description': 'Order placed successfully'},
+        200: {'description': 'Market order filled, with its fill price and the remaining coins, or LIMIT/STOP order resting'},
         400: {'description': 'Invalid request parameters'},
-        404: {'description': 'Stock or group not found'}
+        404: {'description': 'Stock, group or group member not found'}
     }
 })
 def place_order():
+    payload, status = submit_order(request.get_json())
+    return jsonify(payload), status
+
+def submit_order(data):
+    """Validates and executes one market order for /place_order and the place_order socket event.
+
+    Returns (payload, HTTP status). A filled order's payload carries the fill price and the
+    user's available coins after the trade; a LIMIT or STOP order's carries the resting order.
+    """
+    if not isinstance(data, dict):
+        return {"error": "Order must be an object"}, 400
+    order_type = data.get('order_type', 'MARKET')
+    try:
+        if order_type != 'MARKET':
+            order = db.place_pending_order(data.get('group_id'), data.get('user_id'), data.get('stock'),
+                                           data.get('quantity'), data.get('direction'), order_type,
+                                           data.get('trigger_price'))
+            return {"message": "Order accepted", "order": order}, 200
+        fill = db.place_order(data.get('group_id'), data.get('user_id'), data.get('stock'),
+                              data.get('quantity'), data.get('direction'))
+    except OrderRejected as e:
+        return {"error": str(e)}, e.status
+    return {"message": "Order Placed successfully", **fill}, 200
+
+ORDER_REF_PROPERTIES = {
+    'user_id': {'type': 'string'},
+    'group_id': {'type': 'string'},
+    'order_id': {'type': 'string'}
+}
+
+@bp.route('/cancel_order', methods=['POST'])
+@swag_from({
+    'parameters': [
+        {'name': 'body', 'in': 'body', 'required': True, 'schema': {'type': 'object', 'properties': ORDER_REF_PROPERTIES}}
+    ],
+    'responses': {
+        200: {'description': 'Order cancelled'},
+        400: {'description': 'Order already filled, rejected, cancelled or expired'},
+        404: {'description': 'Group or order not found'}
+    }
+})
+def cancel_order():
     data = request.get_json()
-    user_id = data.get('user_id')
-    group_id = data.get('group_id')
-    stock = data.get('stock')
-    quantity = data.get('quantity')
-    direction = data.get('direction')
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be an object"}), 400
+    try:
+        order = db.cancel_order(data.get('group_id'), data.get('user_id'), data.get('order_id'))
+    except OrderRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"order": order}), 200
 
-    group_state = db.get_group_state(group_id)
-    if not group_state:
-        return jsonify({"error": "Group not found"}), 404
+@bp.route('/modify_order', methods=['POST'])
+@swag_from({
+    'parameters': [
+        {'name': 'body', 'in': 'body', 'required': True, 'schema': {'type': 'object', 'properties': {
+            **ORDER_REF_PROPERTIES,
+            'quantity': {'type': 'integer'},
+            'trigger_price': {'type': 'number'}
+        }}}
+    ],
+    'responses': {
+        200: {'description': 'Order modified'},
+        400: {'description': 'Invalid quantity or price, or the order is no longer open'},
+        404: {'description': 'Group or order not found'}
+    }
+})
+def modify_order():
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be an object"}), 400
+    try:
+        order = db.modify_order(data.get('group_id'), data.get('user_id'), data.get('order_id'),
+                                data.get('quantity'), data.get('trigger_price'))
+    except OrderRejected as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"order": order}), 200
 
-    if group_state != "STARTED":
-        return jsonify({"error": "Session is not active"}), 400
+@bp.route('/get_orders/<user_id>/<group_id>', methods=['GET'])
+@swag_from({
+    'parameters': [
+        {'name': 'user_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'User ID'},
+        {'name': 'group_id', 'in': 'path', 'type': 'string', 'required': True, 'description': 'Trading group ID'}
+    ],
+    'responses': {
+        200: {'description': "The user's limit and stop orders with their status"},
+        404: {'description': 'Group not found'}
+    }
+})
+def get_orders(user_id, group_id):
+    if db.get_group_state(group_id) is None:
+        return jsonify({"error": "Group not found"}), 404
+    return jsonify({"orders": db.get_orders(group_id, user_id)}), 200
 
-    if quantity <= 0:
-        return jsonify({"error": "Quantity must be positive"}), 400
-    if direction not in ['BUY', 'SELL']:
-        return jsonify({"error": "Direction must be either BUY or SELL"}), 400
-    price = db.get_stock_prices(group_id, stock)
-    if price is None:
-        return jsonify({"error": "Stock not found"}), 404
+@bp.route('/place_orders', methods=['POST'])
+@swag_from({
+    'parameters': [
+        {'name': 'body', 'in': 'body', 'required': True, 'schema': {
+            'type': 'object',
+            'properties': {
+                'group_id': {'type': 'string'},
+                'user_id': {'type': 'string', 'description': 'Default user for orders that do not name one'},
+                'atomic': {'type': 'boolean', 'description': 'Execute all orders or none of them'},
+                'orders': {'type': 'array', 'items': {
+                    'type': 'object',
+                    'properties': {
+                        'user_id': {'type': 'string'},
+                        'stock': {'type': 'string'},
+                        'quantity': {'type': 'integer'},
+                        'direction': {'type': 'string', 'enum': ['BUY', 'SELL']},
+                        'client_order_id': {'type': 'string', 'description': 'Echoed back in the result'}
+                    }
+                }}
+            }
+        }}
+    ],
+    'responses': {
+        200: {'description': 'One FILLED or REJECTED result per order, in request order'},
+        400: {'description': 'Invalid request parameters'},
+        404: {'description': 'Group not found'}
+    }
+})
+def place_orders():
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Request body must be an object"}), 400
+    group_id = data.get('group_id')
+    orders = data.get('orders')
+    if not isinstance(orders, list) or not orders:
+        return jsonify({"error": "orders must be a non-empty list"}), 400
+    if not all(isinstance(order, dict) for order in orders):
+        return jsonify({"error": "Every order must be an object"}), 400
+    if db.get_group_state(group_id) is None:
+        return jsonify({"error": "Group not found"}), 404
 
-    if direction == 'SELL':
-        positions = db.get_user_positions(group_id, user_id)
-        open_position = None
-        for oP in positions["open_positions"]:
-            if oP.stock == stock:
-                open_position = oP
-        if open_position is None or open_position.quantity < quantity:
-            return jsonify({"error": "Insufficient stock to sell"}), 400
-    elif direction == 'BUY':
-        cost = price * quantity
-        if db.get_user_available_coins(group_id, user_id) < cost:
-            return jsonify({"error": "Insufficient margin"}), 400
-
-    db.execute_trade(user_id, stock, quantity, price, direction, group_id)
-    return jsonify({"message": "Order Placed successfully"}), 200
+    orders = [{**order, "user_id": order.get("user_id", data.get("user_id"))} for order in orders]
+    results = db.place_orders(group_id, orders, bool(data.get('atomic', False)))
+    for order, result in zip(orders, results):
+        if "client_order_id" in order:
+            result["client_order_id"] = order["client_order_id"]
+    return jsonify({"results": results}), 200
 
 @bp.route('/get_price_series/<group_id>/<stock_symbol>/<freq>', methods=['GET'])
 @swag_from({
@@ -192,6 +401,7 @@ def place_order():
     ],
     'responses': {
         200: {'description': 'Stock price series'},
+        400: {'description': 'Session not started or unsupported frequency'},
         404: {'description': 'Stock or group not found'}
     }
 })
@@ -203,7 +413,12 @@ def get_current_price(group_id, stock_symbol, freq):
     if group_state == "CREATED":
         return jsonify({"error": "Session is not started"}), 400
 
-    price = db.get_stock_price_series(group_id, stock_symbol, freq)
+    try:
+        price = db.get_stock_price_series(group_id, stock_symbol, freq)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if price is None:
+        return jsonify({"error": "Stock not found"}), 404
     return jsonify({"price": price}), 200
 
 
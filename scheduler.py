@@ -0,0 +1,151 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import TICK_SECONDS, TICK_LAG_SECONDS, TICK_OVERRUNS, TICKS_SKIPPED
+
+SKIP = "skip"
+CATCH_UP = "catch_up"
+
+
+class _Job:
+    def __init__(self, key, ticks, tick_fn, done_fn):
+        self.key = key
+        self.remaining = ticks
+        self.tick_fn = tick_fn
+        self.done_fn = done_fn
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.overruns = 0
+        self.skipped = 0
+        self.cancelled = False
+
+    def stats(self):
+        return {
+            "remaining_ticks": self.remaining,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skipped,
+        }
+
+
+class TickScheduler:
+    """Runs every active session's ticks from one heap of wall-clock deadlines.
+
+    A single dispatcher thread pops due deadlines and hands them to a small worker pool.
+    Ticks land on multiples of `period`, and a job never runs two ticks at once: its next
+    deadline is only pushed once the current tick has finished. When a tick finishes after
+    the next deadline has already passed, the policy decides what happens:
+    SKIP drops the missed deadlines and waits for the next aligned one, CATCH_UP runs the
+    missed ticks back to back until the job is on schedule again.
+    """
+
+    def __init__(self, period=1.0, workers=4, policy=SKIP):
+        if policy not in (SKIP, CATCH_UP):
+            raise ValueError(f"Unknown overrun policy: {policy}")
+        self.period = period
+        self.policy = policy
+        self._workers = workers
+        self._heap = []
+        self._counter = itertools.count()
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._pool = None
+        self._dispatcher = None
+
+    def schedule(self, key, ticks, tick_fn, done_fn=None):
+        """Runs tick_fn(key) once per period for `ticks` ticks, then done_fn(key)."""
+        job = _Job(key, ticks, tick_fn, done_fn)
+        with self._cond:
+            if key in self._jobs:
+                raise ValueError(f"{key} is already scheduled")
+            self._jobs[key] = job
+            self._start()
+            self._push(self._next_deadline(time.time()), job)
+        return job
+
+    def cancel(self, key):
+        with self._cond:
+            job = self._jobs.pop(key, None)
+            if job is not None:
+                job.cancelled = True
+
+    def lag(self, key):
+        job = self._jobs.get(key)
+        return None if job is None else job.lag
+
+    def stats(self, key=None):
+        with self._cond:
+            if key is not None:
+                job = self._jobs.get(key)
+                return None if job is None else job.stats()
+            return {k: job.stats() for k, job in self._jobs.items()}
+
+    def _next_deadline(self, now):
+        return (math.floor(now / self.period) + 1) * self.period
+
+    def _push(self, deadline, job):
+        heapq.heappush(self._heap, (deadline, next(self._counter), job))
+        self._cond.notify()
+
+    def _start(self):
+        if self._dispatcher is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="tick")
+            self._dispatcher = threading.Thread(target=self._dispatch, name="tick-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, _, job = self._heap[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+            if not job.cancelled:
+                self._pool.submit(self._run, job, deadline)
+
+    def _run(self, job, deadline):
+        started = time.time()
+        job.lag = started - deadline
+        job.max_lag = max(job.max_lag, job.lag)
+        TICK_LAG_SECONDS.observe(job.lag)
+        try:
+            job.tick_fn(job.key)
+        except Exception as e:
+            logging.error(f"Tick failed for {job.key}", exc_info=e)
+        TICK_SECONDS.observe(time.time() - started)
+        job.remaining -= 1
+
+        with self._cond:
+            if job.cancelled:
+                return
+            if job.remaining > 0:
+                next_deadline = deadline + self.period
+                now = time.time()
+                if now > next_deadline:
+                    job.overruns += 1
+                    TICK_OVERRUNS.inc()
+                    if self.policy == SKIP:
+                        aligned = self._next_deadline(now)
+                        skipped = int(round((aligned - next_deadline) / self.period))
+                        job.skipped += skipped
+                        TICKS_SKIPPED.inc(amount=skipped)
+                        next_deadline = aligned
+                self._push(next_deadline, job)
+                return
+            del self._jobs[job.key]
+
+        if job.done_fn is not None:
+            try:
+                job.done_fn(job.key)
+            except Exception as e:
+                logging.error(f"Session completion failed for {job.key}", exc_info=e)
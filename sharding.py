@@ -0,0 +1,19 @@
+import re
+import uuid
+import zlib
+
+# Client-chosen ids end up in room names and file names, so they are kept to a safe alphabet
+GROUP_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def shard_for(group_id: str, shard_count: int) -> int:
+    """Shard owning group_id; stable across processes and restarts, unlike hash()."""
+    return zlib.crc32(group_id.encode()) % shard_count
+
+
+def valid_group_id(group_id) -> bool:
+    return isinstance(group_id, str) and GROUP_ID_PATTERN.fullmatch(group_id) is not None
+
+
+def new_group_id() -> str:
+    return f"GI{int(uuid.uuid4().hex[:12], 16) % 10**10}"
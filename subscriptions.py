@@ -0,0 +1,80 @@
+import threading
+from typing import Dict, List
+
+MARKET = "market"
+DETAILS = "details"
+LEADERBOARD = "leaderboard"
+
+
+def room_name(group_id: str, user_id: str, kind: str, *settings) -> str:
+    return f"{group_id}:{kind}:{user_id}" + "".join(f":{setting}" for setting in settings)
+
+
+def details_room(group_id: str, freq: str, mode: str) -> str:
+    """Room shared by every details subscriber of group_id with this freq and mode; candles go there once."""
+    return f"{group_id}:{DETAILS}:{freq}:{mode}"
+
+
+class SubscriptionRegistry:
+    """Socket subscriptions indexed by group, then user, then subscription type and settings.
+
+    A subscription is a dict with its room_id, user_id, the socket ids joined to that room and
+    its settings (freq, mode, top_n, ...). Sockets of one user with different settings get separate
+    subscriptions, each with the settings in its room name. A per-sid index lets a disconnect drop
+    everything that socket held without scanning other groups.
+    """
+
+    def __init__(self):
+        self._by_group: Dict[str, Dict[str, Dict[str, dict]]] = {}
+        self._by_sid: Dict[str, set] = {}
+        self.lock = threading.RLock()
+
+    def subscribe(self, group_id: str, user_id: str, kind: str, sid: str, **details) -> dict:
+        with self.lock:
+            settings = tuple(details[name] for name in sorted(details))
+            key = (kind,) + settings
+            user_subs = self._by_group.setdefault(group_id, {}).setdefault(user_id, {})
+            sub = user_subs.get(key)
+            if sub is None:
+                sub = user_subs[key] = {"room_id": room_name(group_id, user_id, kind, *settings), "user_id": user_id,
+                                        "sids": set(), **details}
+            sub["sids"].add(sid)
+            self._by_sid.setdefault(sid, set()).add((group_id, user_id, key))
+            return sub
+
+    def unsubscribe_sid(self, sid: str, group_id: str = None) -> List[dict]:
+        """Removes sid from its subscriptions (only those in group_id if given) and returns them."""
+        removed = []
+        with self.lock:
+            keys = self._by_sid.get(sid, set())
+            for key in [k for k in keys if group_id is None or k[0] == group_id]:
+                keys.discard(key)
+                g, user_id, sub_key = key
+                user_subs = self._by_group[g][user_id]
+                sub = user_subs[sub_key]
+                sub["sids"].discard(sid)
+                if not sub["sids"]:
+                    del user_subs[sub_key]
+                    if not user_subs:
+                        del self._by_group[g][user_id]
+                    if not self._by_group[g]:
+                        del self._by_group[g]
+                removed.append(sub)
+            if not keys:
+                self._by_sid.pop(sid, None)
+        return removed
+
+    def drop_group(self, group_id: str):
+        with self.lock:
+            for user_subs in self._by_group.pop(group_id, {}).values():
+                for key, sub in user_subs.items():
+                    for sid in sub["sids"]:
+                        keys = self._by_sid.get(sid)
+                        if keys is not None:
+                            keys.discard((group_id, sub["user_id"], key))
+                            if not keys:
+                                del self._by_sid[sid]
+
+    def subscribers(self, group_id: str, kind: str) -> List[dict]:
+        with self.lock:
+            return [sub for subs in self._by_group.get(group_id, {}).values() for key, sub in subs.items() if key[0] == kind]
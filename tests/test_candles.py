@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from candles import CandleBuilder
+
+FREQS = ["1s", "5s", "7s", "1min", "1h"]
+
+
+def resample_ohlc(prices, started_at, freq):
+    """What the per-call pandas resample used to return, as CandleBuilder records."""
+    index = pd.to_datetime(started_at, unit="s") + pd.to_timedelta(np.arange(len(prices)), unit="s")
+    ohlc = pd.Series(prices, index=index).resample(freq).ohlc()
+    return [{"open": row.open, "high": row.high, "low": row.low, "close": row.close, "timestamp": ts.value // 10**9}
+            for ts, row in ohlc.iterrows()]
+
+
+def random_series(rng, n):
+    return 100 + rng.standard_normal(n).cumsum()
+
+
+@pytest.mark.parametrize("freq", FREQS)
+def test_updates_match_resample(freq):
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        prices = random_series(rng, int(rng.integers(1, 400)))
+        started_at = 1_700_000_000 + int(rng.integers(0, 86400))
+        builder = CandleBuilder(freq, started_at)
+        for i, price in enumerate(prices.tolist()):
+            builder.update(started_at + i, price)
+        assert builder.to_records() == resample_ohlc(prices, started_at, freq)
+
+
+@pytest.mark.parametrize("freq", FREQS)
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_extend_matches_updates(freq, dtype):
+    rng = np.random.default_rng(2)
+    for _ in range(20):
+        n = int(rng.integers(1, 400))
+        prices = random_series(rng, n).astype(dtype)
+        started_at = 1_700_000_000 + int(rng.integers(0, 86400))
+        split = int(rng.integers(0, n + 1))
+        updated, extended = CandleBuilder(freq, started_at), CandleBuilder(freq, started_at)
+        for i, price in enumerate(prices.tolist()):
+            updated.update(started_at + i, price)
+        # A backfill followed by single ticks, as a builder created mid-session sees them
+        extended.extend(started_at, prices[:split])
+        for i in range(split, n):
+            extended.extend(started_at, prices[i:i + 1], i)
+        assert extended.bars == updated.bars
+        assert extended.opened == updated.opened
+        assert all(type(bar[key]) is float for bar in extended.bars for key in ("open", "high", "low", "close"))
+
+
+def test_delta_carries_the_bar_a_tick_closed():
+    builder = CandleBuilder("5s", 1_700_000_000)
+    for i in range(5):
+        builder.update(1_700_000_000 + i, 100.0 + i)
+    assert [bar["close"] for bar in builder.delta()] == [104.0]
+    builder.update(1_700_000_005, 99.0)
+    assert [bar["close"] for bar in builder.delta()] == [104.0, 99.0]
@@ -0,0 +1,78 @@
+from db import InMemoryDB
+from journal import Journal
+
+
+def durable_db(directory):
+    db = InMemoryDB()
+    journal = Journal(str(directory), flush_interval=3600)  # Flushed by hand below
+    snapshot, records = journal.load()
+    db.restore(snapshot, records)
+    journal.start()
+    db.journal = journal
+    return db
+
+
+def recovered_db(directory):
+    db = InMemoryDB()
+    db.restore(*Journal(str(directory)).load())
+    return db
+
+
+def state(db):
+    groups = {}
+    for group_id, group in db._groups.items():
+        groups[group_id] = {
+            "state": group.state,
+            "active_duration": group.active_duration,
+            "prices": {stock: group.current_price(stock) for stock in group.stocks},
+            "members": {user_id: (data.available_coins, data.mtm, len(data.trades))
+                        for user_id, data in group.user_data.items()},
+            "orders": {user_id: db.get_orders(group_id, user_id) for user_id in group.user_data},
+        }
+    return {"users": sorted(db._users), "groups": groups}
+
+
+def trade_and_tick(db, group_id, ticks):
+    for i in range(ticks):
+        db.simulate(group_id)
+        db.place_order(group_id, "u1", "A", 2, "BUY")
+        if i % 2:
+            db.place_order(group_id, "u2", "B", 1, "BUY")
+        db.trigger_orders(group_id)
+
+
+def test_replay_after_snapshot_restores_state(tmp_path):
+    db = durable_db(tmp_path)
+    db.add_users([{"id": "u1", "phone": "1", "name": "a", "password": "p"},
+                  {"id": "u2", "phone": "2", "name": "b", "password": "p"}])
+    db.add_group("g", "G", "u1", ["A", "B"], 100000, 50, seed=7)
+    db.join_group("g", "u2")
+    db.being_session("g")
+    trade_and_tick(db, "g", 5)
+    price = db._groups["g"].current_price("A")
+    db.place_pending_order("g", "u2", "A", 3, "BUY", "LIMIT", price * 0.99)
+    resting = db.place_pending_order("g", "u1", "B", 1, "BUY", "LIMIT", 1.0)
+
+    db.journal.snapshot(lambda lsn: db.snapshot_state())
+    # Everything after the snapshot has to come back from the journal segment alone
+    trade_and_tick(db, "g", 5)
+    db.modify_order("g", "u1", resting["order_id"], quantity=4)
+    db.add_user("u3", "3", "c", "p")
+    db.add_group("h", "H", "u3", ["C"], 1000, 10)
+    db.journal.flush()
+
+    assert state(recovered_db(tmp_path)) == state(db)
+
+
+def test_replay_without_snapshot_restores_state(tmp_path):
+    db = durable_db(tmp_path)
+    db.add_users([{"id": "u1", "phone": "1", "name": "a", "password": "p"},
+                  {"id": "u2", "phone": "2", "name": "b", "password": "p"}])
+    db.add_group("g", "G", "u1", ["A", "B"], 100000, 20)
+    db.join_group("g", "u2")
+    db.being_session("g")
+    trade_and_tick(db, "g", 20)
+    db.end_session("g")
+    db.journal.flush()
+
+    assert state(recovered_db(tmp_path)) == state(db)
@@ -0,0 +1,78 @@
+import random
+
+from orderbook import OrderBook, PendingOrder, LIMIT, STOP, OPEN, FILLED, CANCELLED
+
+
+def order(book, stock="A", direction="BUY", order_type=LIMIT, trigger_price=100.0, user_id="u1"):
+    o = PendingOrder(book.next_order_id(), user_id, stock, 1, direction, order_type, trigger_price)
+    book.add(o)
+    return o
+
+
+def fire(book, stock, price):
+    fired = book.triggered(stock, price)
+    for o in fired:
+        book.close(o, FILLED)
+    return fired
+
+
+def crosses(o, price):
+    return price <= o.trigger_price if o.triggers_below() else price >= o.trigger_price
+
+
+def test_trigger_directions():
+    book = OrderBook()
+    buy_limit = order(book, direction="BUY", order_type=LIMIT, trigger_price=95)
+    sell_limit = order(book, direction="SELL", order_type=LIMIT, trigger_price=105)
+    buy_stop = order(book, direction="BUY", order_type=STOP, trigger_price=110)
+    sell_stop = order(book, direction="SELL", order_type=STOP, trigger_price=90)
+
+    assert fire(book, "A", 100) == []
+    assert fire(book, "A", 95) == [buy_limit]
+    assert fire(book, "A", 106) == [sell_limit]
+    assert fire(book, "A", 89) == [sell_stop]
+    assert fire(book, "A", 110) == [buy_stop]
+    assert book.open_orders() == []
+
+
+def test_only_the_stock_ticked_is_checked():
+    book = OrderBook()
+    a = order(book, stock="A", trigger_price=100)
+    order(book, stock="B", trigger_price=100)
+    assert fire(book, "A", 50) == [a]
+    assert len(book.open_orders()) == 1
+
+
+def test_cancelled_and_repriced_orders():
+    book = OrderBook()
+    cancelled = order(book, trigger_price=100)
+    repriced = order(book, trigger_price=100)
+    book.close(cancelled, CANCELLED)
+    book.reprice(repriced, 90)
+
+    assert fire(book, "A", 95) == []
+    assert fire(book, "A", 90) == [repriced]
+    assert cancelled.status == CANCELLED
+
+
+def test_matches_a_full_scan():
+    rng = random.Random(3)
+    book = OrderBook()
+    for _ in range(500):
+        order(book, stock=rng.choice("AB"), direction=rng.choice(["BUY", "SELL"]),
+              order_type=rng.choice([LIMIT, STOP]), trigger_price=rng.uniform(80, 120), user_id=rng.choice(["u1", "u2"]))
+    price = {"A": 100.0, "B": 100.0}
+    for _ in range(300):
+        for o in rng.sample(book.open_orders(), min(3, len(book.open_orders()))):
+            if rng.random() < 0.5:
+                book.close(o, CANCELLED)
+            else:
+                book.reprice(o, rng.uniform(80, 120))
+        stock = rng.choice("AB")
+        price[stock] *= 1 + rng.uniform(-0.03, 0.03)
+        expected = [o for o in book.open_orders() if o.stock == stock and crosses(o, price[stock])]
+        fired = fire(book, stock, price[stock])
+        assert sorted(o.order_id for o in fired) == sorted(o.order_id for o in expected)
+
+    assert all(o.status == OPEN for o in book.open_orders())
+    assert sorted(o.order_id for o in book.for_user("u1") + book.for_user("u2")) == sorted(book.orders)
@@ -1,17 +1,37 @@
+import zlib
+
 import numpy as np
 
-def generate_stock_time_series(initial_price, duration_seconds):
-    """Generates a semi-realistic stock price time series."""
+MU = 0.001  # Drift (small upward trend)
+SIGMA = 0.02  # Volatility (adjust for desired fluctuation)
+
+
+def generate_group_time_series(initial_prices, duration_seconds, rng=None, mu=MU, sigma=SIGMA):
+    """Generates one price series per initial price in a single vectorized pass.
+
+    Returns an array of shape (len(initial_prices), duration_seconds + 1) where
+    row i starts at initial_prices[i] and follows price += mu * price + sigma * price * N(0, 1).
+    Pass a seeded numpy Generator as rng to make the series reproducible.
+    """
     dt = 1  # Time step (1 second)
-    num_steps = duration_seconds
-    mu = 0.001  # Drift (small upward trend)
-    sigma = 0.02  # Volatility (adjust for desired fluctuation)
-    price = initial_price
-    prices = [price]
-    for _ in range(num_steps):
-        drift = mu * price * dt
-        shock = sigma * price * np.random.normal()
-        price += drift + shock
-        prices.append(price)
+    rng = np.random.default_rng() if rng is None else rng
+    initial_prices = np.asarray(initial_prices, dtype=np.float64).reshape(-1, 1)
+    steps = 1 + mu * dt + sigma * rng.standard_normal((initial_prices.shape[0], duration_seconds))
+    prices = np.empty((initial_prices.shape[0], duration_seconds + 1))
+    prices[:, :1] = initial_prices
+    np.cumprod(steps, axis=1, out=prices[:, 1:])
+    prices[:, 1:] *= initial_prices
     return prices
 
+
+def generate_seeded_series(seed, stock_ids, duration_seconds, mu=MU, sigma=SIGMA):
+    """Series of shape (len(stock_ids), duration_seconds + 1) that only depend on their arguments.
+
+    Each stock draws from its own generator seeded by (seed, stock_id), so a stock's path is the
+    same whatever other stocks share the list.
+    """
+    prices = np.empty((len(stock_ids), duration_seconds + 1))
+    for row, stock_id in enumerate(stock_ids):
+        rng = np.random.default_rng([seed, zlib.crc32(stock_id.encode())])
+        prices[row] = generate_group_time_series([rng.uniform(100, 200)], duration_seconds, rng, mu, sigma)[0]
+    return prices